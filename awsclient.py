@@ -0,0 +1,75 @@
+
+import threading
+
+try:
+    basestring
+except NameError:
+    basestring = str
+
+# Sized to match the widest parallel_map fan-out over AWS calls, so that
+# worker threads never queue for (or discard) pooled connections.
+MAX_POOL_CONNECTIONS = 32
+
+# create_tags accepts at most this many resource IDs per call
+MAX_TAG_RESOURCES = 1000
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def client_config():
+    # Adaptive retry mode adds a client-side token bucket on top of the
+    # standard retries: once EC2 starts throttling, calls from every thread
+    # sharing the client slow down together instead of each retrying on its
+    # own schedule.
+    from botocore.config import Config
+    return Config(
+        retries={"mode": "adaptive", "max_attempts": 10},
+        max_pool_connections=MAX_POOL_CONNECTIONS,
+    )
+
+def get_session(aws_access_key_id, aws_secret_access_key, region_name):
+    # Sessions are pooled per set of credentials for the life of the
+    # process: building one loads botocore's service models from disk.
+    key = (aws_access_key_id, aws_secret_access_key, region_name)
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            import boto3
+            session = _sessions[key] = boto3.Session(
+                aws_access_key_id=aws_access_key_id,
+                aws_secret_access_key=aws_secret_access_key,
+                region_name=region_name
+            )
+
+    return session
+
+def canonical_tags(tags):
+    return tuple(sorted((tag["Key"], tag["Value"]) for tag in tags))
+
+class TagBatch(object):
+    # Collects tag writes for many resources and flushes them with one
+    # create_tags call per distinct set of tags.
+
+    def __init__(self, client):
+        self.client = client
+        self.pending = {}
+        self._lock = threading.Lock()
+
+    def add(self, resource_ids, tags):
+        if isinstance(resource_ids, basestring):
+            resource_ids = (resource_ids,)
+
+        with self._lock:
+            self.pending.setdefault(canonical_tags(tags), []).extend(
+                resource_ids)
+
+    def flush(self):
+        with self._lock:
+            pending, self.pending = self.pending, {}
+
+        for tags, resource_ids in sorted(pending.items()):
+            for index in range(0, len(resource_ids), MAX_TAG_RESOURCES):
+                self.client.create_tags(
+                    Resources=resource_ids[index:index + MAX_TAG_RESOURCES],
+                    Tags=[{"Key": key, "Value": value} for key, value in tags]
+                )
@@ -0,0 +1,332 @@
+#! /usr/bin/env python
+
+import os
+import os.path
+import shutil
+import subprocess as sp
+import sys
+import tempfile
+import time
+
+from argparse import ArgumentParser, Namespace
+from contextlib import contextmanager
+
+_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Offline scenarios run the real orchestration code in main.py against moto's
+# in-process EC2/S3.  Ansible runs, gpg and git are replaced by stubs that
+# only sleep for a configurable amount of time, and every other sleep (fixed
+# pauses, waiters, botocore waiters) is recorded instead of slept.
+#
+# Each scenario fails if it exceeds any of these limits.  Requires moto, which
+# is deliberately not listed in requirements.txt:
+#
+#   pip install moto
+#   python bench.py scenarios --verbose
+#   python bench.py startup
+THRESHOLDS = {
+    "provision": {"wall": 10.0, "api_calls": 150, "sleep": 30.0},
+    "restage": {"wall": 3.0, "api_calls": 5, "sleep": 0.0},
+    "deploy": {"wall": 8.0, "api_calls": 80, "sleep": 30.0},
+}
+
+_BENCH_CONFIG = """
+[default]
+namespace = bench
+region = us-east-1
+ami = ami-12c6146b
+aws_access_key_id = secret://aws-key-id.asc
+aws_secret_access_key = secret://aws-secret-key.asc
+ssh_key_name = bench-ssh
+ssh_key_pub = ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIMG9cprLTJ/dunoEsYjW3AEmXhIvgzGndx98NOre27gd sumobot-bench
+ssh_key_sub = secret://ssh-key.sub.asc
+admin_name = secret://admin_name.asc
+admin_pass = secret://admin_pass.asc
+public_name = secret://public_name.asc
+s3_production_bucket = secret://s3_production_bucket.asc
+s3_staging_bucket = secret://s3_staging_bucket.asc
+production_ip = {production_ip}
+staging_ip = {staging_ip}
+ssl_cert = secret://ssl_cert.asc
+ssl_chain = secret://ssl_chain.asc
+ssl_dhparams = secret://ssl_dhparams.asc
+ssl_key = secret://ssl_key.asc
+"""
+
+def median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    if len(values) % 2:
+        return values[mid]
+    return 0.5*(values[mid - 1] + values[mid])
+
+def bench_startup(args):
+    # in-process: constructing a Deployment must not touch AWS, gpg, or even
+    # import boto3
+    start = time.time()
+    from deployment import Deployment
+    Deployment()
+    construct_time = time.time() - start
+
+    eager_modules = sorted(
+        name for name in ("boto3", "botocore") if name in sys.modules)
+
+    # out-of-process: cold start of the command line up to the point where
+    # an operation would begin (interpreter, imports, Deployment setup).  No
+    # operation is run: those talk to AWS and gpg, and would make results
+    # depend on the network rather than on this code.
+    timings = []
+    with open(os.devnull, "wb") as devnull:
+        for _ in range(args.count):
+            start = time.time()
+            sp.check_call(
+                [sys.executable, "-c", "import main; main.Deployment()"],
+                cwd=_ROOT,
+                stdout=devnull,
+                stderr=devnull,
+            )
+            timings.append(time.time() - start)
+
+    print("import + Deployment(): {:.3f}s".format(construct_time))
+    print("cold start (n={}): min {:.3f}s, median {:.3f}s, max {:.3f}s"
+          .format(len(timings), min(timings), median(timings), max(timings)))
+
+    failed = False
+    if eager_modules:
+        print("FAIL: imported at construction: {}".format(
+            ", ".join(eager_modules)))
+        failed = True
+
+    if median(timings) > args.threshold:
+        print("FAIL: median startup above {:.3f}s".format(args.threshold))
+        failed = True
+
+    return 1 if failed else 0
+
+@contextmanager
+def patched(obj, name, value):
+    original = getattr(obj, name)
+    setattr(obj, name, value)
+    try:
+        yield
+    finally:
+        setattr(obj, name, original)
+
+class Stubs(object):
+    # Latency stubs and accounting for one measured run.
+
+    def __init__(self, args):
+        self.args = args
+        self.real_sleep = time.sleep
+        self.sleep_time = 0.0
+        self.plays = []
+        self.deployments = []
+
+    def sleep(self, seconds):
+        self.sleep_time += seconds
+
+    def decrypt_secret(self, path):
+        self.real_sleep(self.args.gpg_latency)
+        return "bench-" + path
+
+    def run_play(self, deployment, inventory_name, playbook_name, fragments,
+                 global_vars=None):
+        self.plays.append((inventory_name, playbook_name))
+        self.real_sleep(self.args.play_latency)
+
+        # release.yml fetches the artifact it builds back to the controller
+        artifact = (global_vars or {}).get("release_artifact")
+        if "release.yml" in playbook_name:
+            with open(artifact, "wb"):
+                pass
+
+    def release_source(self, deployment, sha):
+        return os.path.join("scratch", "releases", sha + "-src.tar.gz")
+
+    def resolve_rev(self, deployment, rev="master"):
+        self.real_sleep(self.args.git_latency)
+        return rev.ljust(40, "0")[:40]
+
+    @contextmanager
+    def installed(self):
+        import deployment
+
+        stubs = self
+        original_init = deployment.Deployment.__init__
+
+        def init(D):
+            original_init(D)
+            stubs.deployments.append(D)
+
+        with patched(deployment.Deployment, "__init__", init), \
+                patched(deployment.Deployment, "run_play",
+                        lambda D, *a, **k: stubs.run_play(D, *a, **k)), \
+                patched(deployment.Deployment, "resolve_rev",
+                        lambda D, *a, **k: stubs.resolve_rev(D, *a, **k)), \
+                patched(deployment.Deployment, "release_source",
+                        lambda D, *a, **k: stubs.release_source(D, *a, **k)), \
+                patched(deployment.Deployment, "write_trace",
+                        lambda D: None), \
+                patched(deployment, "decrypt_secret", self.decrypt_secret), \
+                patched(time, "sleep", self.sleep):
+            yield
+
+    def api_calls(self):
+        totals = {}
+        for D in self.deployments:
+            for operation, count in D.tracer.api_calls.items():
+                totals[operation] = totals.get(operation, 0) + count
+        return totals
+
+def operation_args(args):
+    # command line of a main.py operation
+    return Namespace(revision=args.revision, force_base=False)
+
+def scenario_provision(main, args):
+    # first-time provisioning: empty account, stage a revision
+    return [lambda: main.stage(operation_args(args))]
+
+def scenario_restage(main, args):
+    # staging a revision that is already staged
+    main.stage(operation_args(args))
+    return [lambda: main.stage(operation_args(args))]
+
+def scenario_deploy(main, args):
+    # blue/green deploy of a staged revision
+    main.stage(operation_args(args))
+    return [lambda: main.deploy(operation_args(args))]
+
+SCENARIOS = (
+    ("provision", scenario_provision),
+    ("restage", scenario_restage),
+    ("deploy", scenario_deploy),
+)
+
+def run_scenario(name, setup, args):
+    try:
+        from moto import mock_aws
+    except ImportError:
+        from moto import mock_ec2 as mock_aws
+
+    import boto3
+
+    if _ROOT not in sys.path:
+        sys.path.insert(0, _ROOT)
+
+    workdir = tempfile.mkdtemp(prefix="sumobot-bench-")
+    cwd = os.getcwd()
+    stdout = sys.stdout
+    try:
+        os.makedirs(os.path.join(workdir, "files"))
+        for name in ("playbooks", "scripts", "templates"):
+            os.symlink(
+                os.path.join(_ROOT, "files", name),
+                os.path.join(workdir, "files", name))
+        os.chdir(workdir)
+
+        with mock_aws():
+            os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+            client = boto3.client("ec2", region_name="us-east-1")
+            production_ip, staging_ip = (
+                client.allocate_address(Domain="vpc")["PublicIp"]
+                for _ in range(2)
+            )
+            with open(os.path.join("files", "aws-config"), "w") as f:
+                f.write(_BENCH_CONFIG.format(
+                    production_ip=production_ip, staging_ip=staging_ip))
+
+            import main
+
+            sys.stdout = open(os.devnull, "w")
+            with Stubs(args).installed():
+                steps = setup(main, args)
+
+            stubs = Stubs(args)
+            with stubs.installed():
+                start = time.time()
+                for step in steps:
+                    step()
+                wall = time.time() - start
+    finally:
+        if sys.stdout is not stdout:
+            sys.stdout.close()
+            sys.stdout = stdout
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    api_calls = stubs.api_calls()
+    return {
+        "wall": wall,
+        "api_calls": sum(api_calls.values()),
+        "api_breakdown": api_calls,
+        "sleep": stubs.sleep_time,
+        "plays": len(stubs.plays),
+    }
+
+def bench_scenarios(args):
+    selected = args.scenario or [name for name, _ in SCENARIOS]
+
+    failed = False
+    for name, setup in SCENARIOS:
+        if name not in selected: continue
+
+        result = run_scenario(name, setup, args)
+        print("{}: wall {:.2f}s, {} api calls, {:.1f}s sleeping, {} plays"
+              .format(name, result["wall"], result["api_calls"],
+                      result["sleep"], result["plays"]))
+
+        if args.verbose:
+            for operation, count in sorted(result["api_breakdown"].items()):
+                print("    {:>4} {}".format(count, operation))
+
+        for key, limit in sorted(THRESHOLDS[name].items()):
+            if result[key] > limit:
+                print("FAIL: {} {} = {} exceeds {}".format(
+                    name, key, result[key], limit))
+                failed = True
+
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument(
+        "benchmark", choices=("startup", "scenarios"),
+        help="benchmark to run"
+    )
+    parser.add_argument(
+        "-s", "--scenario", action="append",
+        choices=[name for name, _ in SCENARIOS],
+        help="offline scenario to run (default: all)"
+    )
+    parser.add_argument(
+        "-v", "--revision", default="benchrev", help="revision to stage"
+    )
+    parser.add_argument(
+        "--play-latency", type=float, default=0.2,
+        help="seconds each stubbed ansible run takes"
+    )
+    parser.add_argument(
+        "--gpg-latency", type=float, default=0.02,
+        help="seconds each stubbed gpg decryption takes"
+    )
+    parser.add_argument(
+        "--git-latency", type=float, default=0.05,
+        help="seconds each stubbed revision lookup takes"
+    )
+    parser.add_argument(
+        "--verbose", action="store_true", help="show api calls per operation"
+    )
+    parser.add_argument(
+        "-n", "--count", type=int, default=10, help="number of repetitions"
+    )
+    parser.add_argument(
+        "-t", "--threshold", type=float, default=1.0,
+        help="maximum acceptable median time, in seconds"
+    )
+
+    args = parser.parse_args()
+
+    sys.exit({
+        "startup": bench_startup,
+        "scenarios": bench_scenarios,
+    }[args.benchmark](args))
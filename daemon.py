@@ -0,0 +1,194 @@
+
+import json
+import os
+import os.path
+import socket
+import threading
+import time
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+from deployment import Deployment
+from jobqueue import JobQueue
+
+SOCKET_PATH = os.path.join("scratch", "sumobot.sock")
+
+# Protocol: a client connects, sends one json request on a single line, and
+# reads json events, one per line, until the daemon closes the connection:
+#
+#   -> {"operation": "stage", "revision": "master"}
+#   <- {"event": "bot", "message": "queued as job 7 at position 2"}
+#   <- {"event": "log", "line": "PLAY [all] ****"}
+#   <- {"event": "done", "code": 0}
+#
+# A job that fails also sends the tail of its output as {"event": "err",
+# "line": ...} events before "done".
+# stage and deploy also take "force_base": true (see main.py --force-base).
+# status, queue and plan (which takes "target": "stage" or "deploy") answer
+# with a single {"event": "result", "data": ...} before "done".  Failures to
+# handle the request at all end with {"event": "error", "message": ...}
+# instead.
+
+class _EventStream(object):
+    # File-like object that turns job output into bot events, and the rest
+    # into events of the given kind.
+
+    def __init__(self, emit, kind="log"):
+        self.emit = emit
+        self.kind = kind
+        self.buffer = ""
+
+    def write(self, data):
+        self.buffer += data
+        lines = self.buffer.split("\n")
+        self.buffer = lines.pop()
+        for line in lines:
+            if line.startswith("BOT: "):
+                self.emit({"event": "bot", "message": line[5:]})
+            else:
+                self.emit({"event": self.kind, "line": line})
+
+    def flush(self):
+        pass
+
+class _Handler(socketserver.StreamRequestHandler):
+    def emit(self, event):
+        self.wfile.write((json.dumps(event) + "\n").encode("utf-8"))
+        self.wfile.flush()
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode("utf-8"))
+            handler = self.server.daemon.handlers[request["operation"]]
+        except (ValueError, KeyError, TypeError):
+            self.emit({"event": "error", "message": "bad request"})
+            return
+
+        try:
+            code = handler(request, self.emit)
+        except socket.error:
+            # client went away; queued jobs carry on regardless
+            return
+        except Exception as e:
+            self.emit({"event": "error", "message": "{}: {}".format(
+                type(e).__name__, e)})
+            return
+
+        self.emit({"event": "done", "code": code or 0})
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class Daemon(object):
+    # Long-lived process that keeps a warm Deployment (boto3 imported,
+    # secrets decrypted, session and vpc looked up) to answer status queries,
+    # and that is also the job queue's runner.  Mutating operations still run
+    # as separate processes through the queue: a Deployment carries state
+    # from one operation that the next one must not see.
+
+    def __init__(self, job_argv, path=SOCKET_PATH):
+        self.path = path
+        self.job_argv = job_argv
+        self.deployment = Deployment()
+        self.queue = JobQueue()
+        self.lock = threading.Lock()
+        self.handlers = {
+            "deploy": self.submit,
+            "plan": self.plan,
+            "queue": self.report_queue,
+            "stage": self.submit,
+            "status": self.status,
+        }
+
+    def warm_up(self):
+        D = self.deployment
+        D.secrets.prefetch()
+        D.vpc
+        D.inventory.load()
+
+    def status(self, request, emit):
+        with self.lock:
+            self.deployment.tracer.reset()
+            # the inventory is only a snapshot; take a fresh one
+            self.deployment.inventory.invalidate()
+            report = self.deployment.status()
+
+        emit({"event": "result", "data": report})
+
+    def plan(self, request, emit):
+        with self.lock:
+            self.deployment.tracer.reset()
+            self.deployment.forget_lookups()
+            report = self.deployment.plan(
+                request.get("target") or "stage",
+                request.get("revision") or "master",
+                bool(request.get("force_base")))
+
+        emit({"event": "result", "data": report})
+
+    def report_queue(self, request, emit):
+        emit({"event": "result", "data": self.queue.report()})
+
+    def submit(self, request, emit):
+        operation = request["operation"]
+
+        revision = sha = None
+        if operation == "stage":
+            revision = request.get("revision") or "master"
+            with self.lock:
+                self.deployment.tracer.reset()
+                # don't reuse earlier resolutions (see forget_lookups)
+                self.deployment.forget_lookups()
+                sha = self.deployment.resolve_rev(revision)
+
+        options = {}
+        if request.get("force_base"):
+            options["force_base"] = True
+
+        # this process is the runner (or will be, once any other runner
+        # lets go of the queue), so there is never one to start
+        return self.queue.request(
+            operation, revision, sha, None,
+            lambda message: emit({"event": "bot", "message": message}),
+            _EventStream(emit), options, _EventStream(emit, "err"))
+
+    def run_queue(self):
+        while True:
+            if not self.queue.run(self.job_argv, idle_exit=False):
+                # another runner holds the queue; take over when it exits
+                time.sleep(5)
+
+    def serve_forever(self):
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+            except socket.error:
+                os.remove(self.path)
+            else:
+                raise RuntimeError(
+                    "a daemon is already listening on {}".format(self.path))
+            finally:
+                probe.close()
+
+        self.warm_up()
+
+        runner = threading.Thread(target=self.run_queue)
+        runner.daemon = True
+        runner.start()
+
+        old_umask = os.umask(0o077)
+        try:
+            server = _Server(self.path, _Handler)
+        finally:
+            os.umask(old_umask)
+
+        server.daemon = self
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.remove(self.path)
@@ -1,20 +1,58 @@
 
+import atexit
+import hashlib
 import json
 import os
 import os.path
+import re
+import shutil
+import socket
 import sys
+import tarfile
+import tempfile
+import threading
 import time
+import traceback
 
 import itertools as it
 import subprocess as sp
 
 from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 
-import boto3
-import botocore.exceptions
+import awsclient
+import waiters
+
+from journal import Journal
+from tracing import Tracer, traced
+
+try:
+    basestring
+except NameError:
+    basestring = str
 
 _DEVNULL = open(os.devnull, "wb")
 _SECRET_PREFIX = "secret://"
+_FULL_SHA = re.compile("^[0-9a-f]{40}$")
+_RELEASE_PREFIX = "sumobot-releases/"
+
+# what a playbook reads from the controller (see playbook_files)
+_PLAYBOOK_INCLUDE = re.compile(r"^\s*-?\s*include:\s*(\S+)", re.M)
+_PLAYBOOK_SRC = re.compile(r"^\s*src:\s*[\"']?([^\s\"']+)", re.M)
+
+# what every play reads besides its playbooks: ansible.cfg and the roles,
+# modules and filters it points at
+_ANSIBLE_PATHS = (
+    "ansible.cfg",
+    os.path.join("gobig", "roles"),
+    os.path.join("gobig", "library"),
+    os.path.join("gobig", "filter_plugins"),
+)
+
+# recent durations of plays and instance launches, for plan estimates
+_DURATIONS_PATH = os.path.join("scratch", "durations.json")
+_DURATIONS_KEPT = 10
+_DEFAULT_ESTIMATES = {"launch": 90.0, "play": 300.0}
 
 def get_tag(tag_list, key, default=None):
     result = default
@@ -27,21 +65,291 @@ def get_tag(tag_list, key, default=None):
 
     return result
 
+def parallel_map(func, items, max_workers=None, tracer=None):
+    # With a tracer, func's spans nest under the caller's current span.
+    if tracer is not None:
+        func = tracer.wrap(func)
+
+    items = list(items)
+    if len(items) < 2:
+        return [func(item) for item in items]
+
+    pool = ThreadPool(min(len(items), max_workers or len(items)))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+def playbook_files(names):
+    # The paths of the playbooks names (in files/playbooks), of the
+    # playbooks they include, and of the controller files (e.g.: templates)
+    # they copy to the hosts.
+    playbook_dir = os.path.join("files", "playbooks")
+    todo = [os.path.join(playbook_dir, name) for name in names]
+    paths = set()
+    while todo:
+        path = os.path.normpath(todo.pop())
+        if path in paths: continue
+        paths.add(path)
+
+        with open(path) as f:
+            text = f.read()
+
+        for match in _PLAYBOOK_INCLUDE.finditer(text):
+            todo.append(os.path.join(playbook_dir, match.group(1)))
+
+        for match in _PLAYBOOK_SRC.finditer(text):
+            src = os.path.normpath(os.path.join(playbook_dir, match.group(1)))
+            if os.path.isfile(src):
+                paths.add(src)
+
+    return sorted(paths)
+
+def hash_files(digest, paths):
+    # Feed the names and contents of paths (files, or directories, walked in
+    # order) to digest.  Paths that do not exist are skipped.
+    for path in paths:
+        if os.path.isdir(path):
+            names = sorted(
+                os.path.join(parent, name)
+                for parent, _, files in os.walk(path)
+                for name in files)
+        elif os.path.exists(path):
+            names = [path]
+        else:
+            continue
+
+        for name in names:
+            digest.update(name.encode("utf-8"))
+            with open(name, "rb") as f:
+                digest.update(f.read())
+
+def block_device_mappings(volumes):
+    return [
+        {
+            "DeviceName": "xvd" + chr(ord("b") + index),
+            "Ebs": {
+                "VolumeSize": volume,
+                "DeleteOnTermination": True
+            }
+        }
+        for (index, volume) in enumerate(volumes)
+    ]
+
+def probe_port(host, port, timeout=2.0):
+    try:
+        sock = socket.create_connection((host, port), timeout)
+    except (socket.error, socket.timeout):
+        return False
+
+    sock.close()
+    return True
+
+def probe_girder(host, port=8080, timeout=3.0):
+    try:
+        from urllib.request import urlopen
+    except ImportError:
+        from urllib2 import urlopen
+
+    url = "http://{}:{}/api/v1/system/version".format(host, port)
+    try:
+        response = urlopen(url, timeout=timeout)
+        try:
+            return json.loads(response.read().decode("utf-8"))
+        finally:
+            response.close()
+    except Exception:
+        return None
+
+def decrypt_secret(path):
+    return sp.check_output(
+        [ "gpg", "--decrypt", os.path.join("files", path) ],
+        stderr=_DEVNULL
+    )[:-1]
+
 def get_from_parser(parser, key):
     result = parser.get("default", key)
     if result.startswith(_SECRET_PREFIX):
-        path = result[len(_SECRET_PREFIX):]
-        result = sp.check_output(
-            [ "gpg", "--decrypt", os.path.join("files", path) ],
-            stderr=_DEVNULL
-        )[:-1]
+        result = decrypt_secret(result[len(_SECRET_PREFIX):])
 
     return result
 
+class SecretStore(object):
+    # Lazily decrypted view over the [default] section of files/aws-config.
+    #
+    # Plain values are returned as-is.  secret:// values are decrypted with
+    # gpg on first access and then kept in memory (never on disk) for the
+    # lifetime of the store.  prefetch() decrypts every outstanding secret in
+    # parallel.
+
+    def __init__(self, parser):
+        self.parser = parser
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def keys(self):
+        return self.parser.options("default")
+
+    def secret_path(self, key):
+        value = self.parser.get("default", key)
+        if value.startswith(_SECRET_PREFIX):
+            return value[len(_SECRET_PREFIX):]
+
+    def get(self, key):
+        with self._lock:
+            if key in self._values:
+                return self._values[key]
+
+        path = self.secret_path(key)
+        if path is None:
+            value = self.parser.get("default", key)
+        else:
+            value = decrypt_secret(path)
+
+        with self._lock:
+            return self._values.setdefault(key, value)
+
+    def prefetch(self, keys=None):
+        if keys is None: keys = self.keys()
+        with self._lock:
+            todo = [
+                key for key in keys
+                if key not in self._values
+                and self.secret_path(key) is not None
+            ]
+
+        parallel_map(self.get, todo)
+
+class ConfigValue(object):
+    # Deployment attribute backed by a SecretStore entry.
+    def __init__(self, key):
+        self.key = key
+
+    def __get__(self, obj, objtype=None):
+        if obj is None: return self
+        return obj.secrets.get(self.key)
+
+class Inventory(object):
+    # Snapshot of every live instance in a namespace, loaded with a single
+    # DescribeInstances query and indexed by (role, state, revision) tags.
+    # Deployment invalidates it whenever it creates, retags or terminates
+    # instances; the next lookup reloads it.  Safe to share between the
+    # threads of a Deployment (e.g.: background jobs).
+
+    LIVE_STATES = ("pending", "running", "stopping", "stopped")
+
+    def __init__(self, ec2, namespace):
+        self.ec2 = ec2
+        self.namespace = namespace
+        self._lock = threading.RLock()
+        self.invalidate()
+
+    def invalidate(self):
+        with self._lock:
+            self._instances = None
+            self._index = None
+
+    def load(self):
+        with self._lock:
+            return self._load()
+
+    def _load(self):
+        if self._instances is None:
+            self._instances = dict(
+                (instance.id, instance)
+                for instance in self.ec2.instances.filter(Filters=[
+                    {"Name": "tag:namespace", "Values": [self.namespace]},
+                    {"Name": "instance-state-name",
+                     "Values": list(self.LIVE_STATES)},
+                ])
+            )
+            self._reindex()
+
+        return self._instances
+
+    def _reindex(self):
+        self._index = {}
+        for instance in self._instances.values():
+            tags = instance.tags or []
+            key = (
+                get_tag(tags, "role"),
+                get_tag(tags, "state"),
+                get_tag(tags, "revision"),
+            )
+            self._index.setdefault(key, []).append(instance)
+
+    def select(self, role=None, state=None, revision=None):
+        with self._lock:
+            self._load()
+            index = self._index
+
+        def match(value, expected):
+            if expected is None: return True
+            if isinstance(expected, (tuple, list, set, frozenset)):
+                return value in expected
+            return value == expected
+
+        return [
+            instance
+            for (i_role, i_state, i_rev), instances
+                in sorted(index.items(), key=lambda kv: str(kv[0]))
+            if match(i_role, role)
+            and match(i_state, state)
+            and match(i_rev, revision)
+            for instance in sorted(instances, key=lambda inst: inst.id)
+        ]
+
+    def get(self, instance_ids):
+        # Describe the given instances directly (by id, not by tag, so that
+        # freshly launched instances show up regardless of tag propagation)
+        # and fold the fresh copies back into the snapshot.
+        instance_ids = list(instance_ids)
+        if not instance_ids:
+            return []
+
+        fresh = list(self.ec2.instances.filter(InstanceIds=instance_ids))
+        with self._lock:
+            if self._instances is not None:
+                for instance in fresh:
+                    if instance.state["Name"] in self.LIVE_STATES:
+                        self._instances[instance.id] = instance
+                    else:
+                        self._instances.pop(instance.id, None)
+                self._reindex()
+
+        return fresh
+
 class Deployment(object):
 
+    aws_access_key_id = ConfigValue("aws_access_key_id")
+    aws_secret_access_key = ConfigValue("aws_secret_access_key")
+
+    region = ConfigValue("region")
+    namespace = ConfigValue("namespace")
+    ami = ConfigValue("ami")
+
+    admin_name = ConfigValue("admin_name")
+    admin_pass = ConfigValue("admin_pass")
+
+    public_name = ConfigValue("public_name")
+
+    staging_ip    = ConfigValue("staging_ip")
+    production_ip = ConfigValue("production_ip")
+
+    ssl_cert = ConfigValue("ssl_cert")
+    ssl_chain = ConfigValue("ssl_chain")
+    ssl_dhparams = ConfigValue("ssl_dhparams")
+    ssl_key = ConfigValue("ssl_key")
+
+    s3_staging_bucket = ConfigValue("s3_staging_bucket")
+    s3_production_bucket = ConfigValue("s3_production_bucket")
+
     def __init__(self):
+        self.tracer = Tracer()
         self.security_count = 0
+        self.secured_ids = set()
+        self.background = []
         self.bot_msg_cache = set()
         try:
             from configparser import SafeConfigParser as ConfigParser
@@ -51,59 +359,33 @@ class Deployment(object):
         parser = ConfigParser()
         parser.read([os.path.join("files", "aws-config")])
 
-        access_key_id = get_from_parser(parser, "aws_access_key_id")
-        secret_access_key = get_from_parser(parser, "aws_secret_access_key")
-
-        self.region = get_from_parser(parser, "region")
-        self.namespace = get_from_parser(parser, "namespace")
-        self.ami = get_from_parser(parser, "ami")
-
-        self.admin_name = get_from_parser(parser, "admin_name")
-        self.admin_pass = get_from_parser(parser, "admin_pass")
-
-        self.public_name = get_from_parser(parser, "public_name")
-
-        self.staging_ip    = get_from_parser(parser, "staging_ip")
-        self.production_ip = get_from_parser(parser, "production_ip")
-
-        self.ssl_cert = get_from_parser(parser, "ssl_cert")
-        self.ssl_chain = get_from_parser(parser, "ssl_chain")
-        self.ssl_dhparams = get_from_parser(parser, "ssl_dhparams")
-        self.ssl_key = get_from_parser(parser, "ssl_key")
-
-        self.s3_staging_bucket = (
-            get_from_parser(parser, "s3_staging_bucket"))
-        self.s3_production_bucket = (
-            get_from_parser(parser, "s3_production_bucket"))
-
-        self.ssh_key = {
-            "name": get_from_parser(parser, "ssh_key_name"),
-            "pub": get_from_parser(parser, "ssh_key_pub"),
-            "sub": get_from_parser(parser, "ssh_key_sub")
-        }
+        self.secrets = SecretStore(parser)
 
         try: os.makedirs("scratch", mode=0o700)
         except OSError: pass
 
-        self.ssh_key_path = os.path.join("scratch", "ssh-key")
-        if not os.path.exists(self.ssh_key_path):
-            with open(self.ssh_key_path, "w") as f:
-                f.write(self.ssh_key["sub"])
+        # left behind by versions that cached decrypted secrets on disk
+        shutil.rmtree(
+            os.path.join("scratch", "secret-cache"), ignore_errors=True)
 
-        os.chmod(self.ssh_key_path, 0o600)
-
-        self.session = boto3.Session(
-            aws_access_key_id=access_key_id,
-            aws_secret_access_key=secret_access_key,
-            region_name=self.region
-        )
+        self._session = None
+        self._ec2 = None
+        self._s3 = None
+        self._vpc = None
+        self._inventory = None
+        self._ssh_key_path = None
+        self._ansible_dir = None
 
-        self.aws_access_key_id = access_key_id
-        self.aws_secret_access_key = secret_access_key
+        self.submodule = "osumo-project"
+        self.rev_cache = {}
 
-        self.ec2 = self.session.resource("ec2")
+        self._golden_image = {}
+        self.deps_installed = set()
 
-        self.vpc = next(iter(self.ec2.vpcs.all()))
+        self.wait_times = {}
+        self.timeline = []
+        self.durations_lock = threading.Lock()
+        self.journal = Journal()
 
         self.static_security_group_conf = (
             {
@@ -191,51 +473,326 @@ class Deployment(object):
                 "volumes": [20],
                 "groups": ["internal"],
             },
+
+            # package cache for the dynamic hosts (see cache.yml)
+            "cache": {
+                "type": "t2.small",
+                "volumes": [40],
+                "groups": ["internal"],
+            },
         }
 
+        # inventory groups of base.yml and cache.yml (see rolling_base)
+        self.base_groups = {
+            "db": ("s/db+mq", "p/db"),
+            "mq": ("s/db+mq", "p/queue"),
+            "stage": ("s/db+mq", ),
+            "prod": ("p/queue", ),
+            "cache": ("cache", ),
+        }
+
+        # steps of stage and deploy, each with the steps it comes after (see
+        # plan, and main.apply_plan)
+        self.step_graph = {
+            "stage": (
+                ("base", ()),
+                ("launch", ()),
+                ("prep", ("base", "launch")),
+                ("launch-pending", ("launch",)),
+                ("stage", ("base", "prep", "launch-pending")),
+            ),
+            "deploy": (
+                ("base", ()),
+                ("launch", ()),
+                ("prep", ("base", "launch")),
+                ("deploy", ("prep",)),
+            ),
+        }
+
+        # "warm": instances of the role kept ready (launched from the golden
+        # image and tagged state=warm) for rolling_stage to claim instead of
+        # launching new ones.  With "stop", they wait in the stopped state.
+        # Off unless configured, e.g.: "warm": {"count": 1, "stop": True}.
         self.dynamic_instance_conf = {
             "web": {
                 "type": "t2.small",
                 "volumes": [20],
                 "groups": ["web"],
+                "baked": True,
             },
 
             "worker": {
                 "type": "t2.large",
                 "volumes": [20],
                 "groups": ["internal"],
+                "baked": True,
             },
         }
 
+        # instance used to bake the golden image for dynamic instances
+        self.builder_instance_conf = {
+            "type": "t2.large",
+            "volumes": [20],
+            "groups": ["internal"],
+        }
+
         self.instances = {}
 
+    @property
+    def session(self):
+        if self._session is None:
+            self._session = awsclient.get_session(
+                self.aws_access_key_id,
+                self.aws_secret_access_key,
+                self.region
+            )
+
+        return self._session
+
+    @property
+    def ec2(self):
+        if self._ec2 is None:
+            self._ec2 = self.session.resource(
+                "ec2", config=awsclient.client_config())
+
+            # instrument the client rather than the (shared) session, so
+            # that the tracer only counts this deployment's calls
+            self.tracer.instrument(self._ec2.meta.client.meta)
+            atexit.register(self.write_trace)
+
+        return self._ec2
+
+    @property
+    def s3(self):
+        if self._s3 is None:
+            self._s3 = self.session.client(
+                "s3", config=awsclient.client_config())
+            self.tracer.instrument(self._s3.meta)
+
+        return self._s3
+
+    @property
+    def vpc(self):
+        if self._vpc is None:
+            self._vpc = next(iter(self.ec2.vpcs.all()))
+
+        return self._vpc
+
+    @property
+    def inventory(self):
+        if self._inventory is None:
+            self._inventory = Inventory(self.ec2, self.namespace)
+
+        return self._inventory
+
+    @property
+    def ssh_key_path(self):
+        if self._ssh_key_path is None:
+            path = os.path.join("scratch", "ssh-key")
+            if not os.path.exists(path):
+                with open(path, "w") as f:
+                    f.write(self.ssh_key["sub"])
+
+            os.chmod(path, 0o600)
+            self._ssh_key_path = path
+
+        return self._ssh_key_path
+
+    @property
+    def ssh_key(self):
+        return {
+            "name": self.secrets.get("ssh_key_name"),
+            "pub": self.secrets.get("ssh_key_pub"),
+            "sub": self.secrets.get("ssh_key_sub")
+        }
+
+    @property
+    def ansible_dir(self):
+        # Per-session state shared by every play this Deployment runs: the ssh
+        # ControlPersist sockets (so that connections opened by one play are
+        # reused by the next) and the gathered-facts cache.
+        if self._ansible_dir is None:
+            path = os.path.abspath(os.path.join(
+                "scratch", "ansible", str(os.getpid())))
+
+            for subdir in ("cp", "facts"):
+                try: os.makedirs(os.path.join(path, subdir), 0o700)
+                except OSError: pass
+
+            self._ansible_dir = path
+            atexit.register(self.close_ansible)
+
+        return self._ansible_dir
+
+    def close_ansible(self):
+        if self._ansible_dir is None:
+            return
+
+        control_dir = os.path.join(self._ansible_dir, "cp")
+        for name in os.listdir(control_dir):
+            self.close_control_master(os.path.join(control_dir, name))
+
+        shutil.rmtree(self._ansible_dir, ignore_errors=True)
+        self._ansible_dir = None
+
+    def close_control_master(self, path):
+        sp.call(
+            ["ssh", "-o", "ControlPath=" + path, "-O", "exit", "localhost"],
+            stdout=_DEVNULL,
+            stderr=_DEVNULL,
+        )
+
+    def forget_host(self, ip):
+        # The ssh connections and cached facts of this session are keyed by
+        # public ip; once ip moves to another instance, neither applies to the
+        # host behind it.
+        if self._ansible_dir is None:
+            return
+
+        control_dir = os.path.join(self._ansible_dir, "cp")
+        for name in os.listdir(control_dir):
+            if name.startswith(ip + "-"):
+                self.close_control_master(os.path.join(control_dir, name))
+
+        try: os.remove(os.path.join(self._ansible_dir, "facts", ip))
+        except OSError: pass
+
+    def ansible_env(self):
+        env = dict(os.environ)
+        env.update({
+            "ANSIBLE_SSH_CONTROL_PATH": os.path.join(
+                self.ansible_dir, "cp", "%%h-%%p-%%r"),
+            "ANSIBLE_CACHE_PLUGIN_CONNECTION": os.path.join(
+                self.ansible_dir, "facts"),
+        })
+        return env
+
     def run_play(self, inventory_name, playbook_name, fragments,
                  global_vars=None):
         if global_vars is None: global_vars = {}
-        inventory_dir = os.path.join("scratch", inventory_name)
-        inventory_path = os.path.join(inventory_dir, "hosts")
 
+        # the inventory carries secrets: hand it over in a file only we can
+        # read, rather than in the environment
+        env = self.ansible_env()
+        fd, inventory_path = tempfile.mkstemp(
+            suffix=".json", dir=self.ansible_dir)
+        with os.fdopen(fd, "w") as f:
+            json.dump(self.generate_inventory(fragments, global_vars), f)
+        env["SUMOBOT_INVENTORY"] = inventory_path
+
+        playbooks = playbook_name
+        if isinstance(playbooks, basestring):
+            playbooks = [playbooks]
+
+        timeline_dir = os.path.join("scratch", "timeline")
+        try: os.makedirs(timeline_dir)
+        except OSError: pass
+
+        timeline_path = os.path.abspath(os.path.join(
+            timeline_dir, "{}-{}.json".format(
+                time.strftime("%Y%m%dT%H%M%S"), inventory_name)))
+        env["SUMOBOT_TIMELINE"] = timeline_path
+
+        start = time.time()
+        with self.tracer.span("run_play", inventory=inventory_name):
+            try:
+                sp.check_call([
+                    "ansible-playbook",
+                    "-i",
+                    os.path.join("files", "inventory.py"),
+                ] + [
+                    os.path.join("files", "playbooks", playbook)
+                    for playbook in playbooks
+                ], env=env)
+            finally:
+                os.remove(inventory_path)
+                self.record_timeline(
+                    timeline_path, inventory_name, playbooks, start)
+
+        self.record_duration("play:" + inventory_name, time.time() - start)
+
+    def record_timeline(self, path, inventory_name, playbooks, start):
         try:
-            os.mkdir(inventory_dir)
-        except OSError:
-            pass
+            with open(path) as f:
+                timeline = json.load(f)
+        except (IOError, OSError, ValueError):
+            timeline = {"entries": []}
+
+        timeline.update({
+            "inventory": inventory_name,
+            "playbooks": playbooks,
+            "start": start,
+            "duration": time.time() - start,
+        })
+
+        with open(path, "w") as f:
+            json.dump(timeline, f, indent=2)
+
+        for entry in timeline["entries"]:
+            entry["inventory"] = inventory_name
+            self.timeline.append(entry)
+
+    def report_timeline(self, count=5):
+        slowest = sorted(
+            self.timeline, key=lambda entry: entry["duration"], reverse=True)
+        if not slowest:
+            return
 
-        with open(inventory_path, "w") as f:
-            f.write("\n".join(
-                self.generate_inventory_fragment(
-                    group_name, group_keys, global_vars, inventory_dir)
+        self.send_bot("slowest tasks:")
+        for entry in slowest[:count]:
+            self.send_bot("  {:.1f}s {} on {} ({})".format(
+                entry["duration"],
+                entry["task"],
+                entry["host"],
+                entry["inventory"]))
+
+    def record_duration(self, key, seconds):
+        # Keep the last few durations of key ("play:<inventory name>" or
+        # "launch:<role>"), for estimate().
+        with self.durations_lock:
+            try:
+                with open(_DURATIONS_PATH) as f:
+                    durations = json.load(f)
+            except (IOError, OSError, ValueError):
+                durations = {}
+
+            history = durations.setdefault(key, [])
+            history.append(round(seconds, 1))
+            del history[:-_DURATIONS_KEPT]
+
+            tmp_path = _DURATIONS_PATH + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(durations, f, indent=2, sort_keys=True)
+            os.rename(tmp_path, _DURATIONS_PATH)
+
+    def estimate(self, key):
+        # Median of the recorded durations of key, or a guess by kind if
+        # there are none yet.
+        try:
+            with open(_DURATIONS_PATH) as f:
+                history = sorted(json.load(f).get(key, ()))
+        except (IOError, OSError, ValueError):
+            history = []
 
-                for group_name, group_keys in fragments.items()
-            ))
+        if not history:
+            return _DEFAULT_ESTIMATES[key.split(":", 1)[0]]
 
-            f.flush()
+        return history[len(history)//2]
 
-        sp.check_call([
-            "ansible-playbook",
-            "-i",
-            inventory_path,
-            os.path.join("files", "playbooks", playbook_name),
-        ])
+    @contextmanager
+    def tagging(self):
+        # Coalesce the tag writes made in the block into as few create_tags
+        # calls as possible; they are sent when the block exits.
+        batch = awsclient.TagBatch(self.ec2.meta.client)
+        yield batch
+        batch.flush()
+
+    def write_trace(self):
+        self.tracer.write(
+            os.path.join("scratch", "trace.json"),
+            os.path.join(
+                os.environ.get("SUMOBOT_TEXTFILE_DIR", "scratch"),
+                "sumobot.prom"))
 
     def send_bot(self, msg):
         if msg in self.bot_msg_cache:
@@ -245,6 +802,178 @@ class Deployment(object):
         print("BOT: {}".format(msg))
         sys.stdout.flush()
 
+    def wait(self, phase, condition, **kwds):
+        kwds.setdefault("description", phase)
+        with self.tracer.span("wait", phase=phase):
+            result, elapsed = waiters.wait_for(condition, **kwds)
+        self.wait_times[phase] = self.wait_times.get(phase, 0.0) + elapsed
+        self.send_bot("waited {:.1f}s for {}".format(elapsed, phase))
+        return result
+
+    def tags_visible(self, instances, key, value):
+        import botocore.exceptions
+
+        instance_ids = set(instance.id for instance in instances)
+        try:
+            response = self.ec2.meta.client.describe_instances(
+                InstanceIds=list(instance_ids),
+                Filters=[{"Name": "tag:" + key, "Values": [value]}])
+        except botocore.exceptions.ClientError:
+            return False
+
+        return instance_ids <= set(
+            instance["InstanceId"]
+            for reservation in response["Reservations"]
+            for instance in reservation["Instances"]
+        )
+
+    def security_groups_visible(self, group_ids):
+        import botocore.exceptions
+
+        try:
+            self.ec2.meta.client.describe_security_groups(
+                GroupIds=list(group_ids))
+        except botocore.exceptions.ClientError:
+            return False
+
+        return True
+
+    def associate_address(self, ip, instance):
+        next(iter(
+            self.ec2.vpc_addresses.filter(PublicIps=[ip])
+        )).associate(
+            InstanceId=instance.id,
+            AllowReassociation=True
+        )
+        self.forget_host(ip)
+
+    def refresh_instances(self):
+        # re-describe every instance in self.instances with a single call
+        entries = []
+        for role, entry in self.instances.items():
+            if isinstance(entry, dict):
+                entries.extend(
+                    (role, state) for state in entry.keys())
+            else:
+                entries.append((role, None))
+
+        def get(role, state):
+            entry = self.instances[role]
+            return entry if state is None else entry[state]
+
+        fresh = dict(
+            (instance.id, instance)
+            for instance in self.inventory.get(
+                instance.id
+                for role, state in entries
+                for instance in get(role, state)
+            )
+        )
+
+        for role, state in entries:
+            instances = [fresh[instance.id] for instance in get(role, state)
+                         if instance.id in fresh]
+            if state is None:
+                self.instances[role] = instances
+            else:
+                self.instances[role][state] = instances
+
+    def launch_instances(self, role, conf, count, extra_groups=()):
+        groups = list(conf.get("groups", [])) + list(extra_groups)
+        if self.security_count > 0:
+            groups.append("temp")
+        groups = sorted(set(groups), key=groups.index)
+
+        image_id = self.ami
+        if conf.get("baked"):
+            golden = self.golden_image()
+            if golden is not None:
+                image_id = golden.id
+
+        new_instances = self.ec2.create_instances(
+            ImageId=image_id,
+            KeyName=self.namespace,
+            InstanceType=conf.get("type", "t2.nano"),
+            MinCount=count,
+            MaxCount=count,
+            BlockDeviceMappings=block_device_mappings(conf.get("volumes", [])),
+            SecurityGroupIds=[
+                self.static_security_groups[group_name]
+                for group_name in groups
+            ]
+        )
+
+        if "temp" in groups:
+            self.secured_ids.update(instance.id for instance in new_instances)
+
+        return new_instances
+
+    def provision_instances(self, requests, tags=()):
+        # requests: sequence of (role, conf, state, count, extra_groups)
+        #
+        # All roles are launched up front, so their boot times overlap instead
+        # of adding up.  Each role is then waited on and tagged (with tags
+        # in addition to its own) in its own thread; the returned mapping is
+        # role -> list of new instances.
+        start = time.time()
+
+        launched = []
+        for role, conf, state, count, extra_groups in requests:
+            if count <= 0: continue
+            launch_start = time.time()
+            launched.append((
+                role, state,
+                self.launch_instances(role, conf, count, extra_groups),
+                launch_start))
+
+        def wait_and_tag(entry):
+            role, state, new_instances, launch_start = entry
+            parallel_map(
+                lambda instance: instance.wait_until_running(), new_instances,
+                tracer=self.tracer)
+
+            self.ec2.create_tags(
+                Resources=[inst.id for inst in new_instances],
+                Tags=[
+                    {"Key": "Name",
+                     "Value": "/".join((self.namespace, role))},
+                    {"Key": "namespace", "Value": self.namespace},
+                    {"Key": "role", "Value": role},
+                    {"Key": "state", "Value": state}
+                ] + list(tags)
+            )
+
+            # each role's own time, from its launch to its instances running
+            return role, time.time() - launch_start
+
+        timings = parallel_map(wait_and_tag, launched, tracer=self.tracer)
+        if launched:
+            self.inventory.invalidate()
+
+        if timings:
+            for role, elapsed in timings:
+                self.send_bot("{} instances running after {:.1f}s".format(
+                    role, elapsed))
+                self.record_duration("launch:" + role, elapsed)
+
+            self.send_bot(
+                "provisioned {} in {:.1f}s (serial estimate: {:.1f}s)"
+                .format(
+                    ", ".join(role for role, _ in timings),
+                    time.time() - start,
+                    sum(elapsed for _, elapsed in timings)))
+
+        return dict((role, new_instances)
+                    for role, _, new_instances, _ in launched)
+
+    def terminate_instances(self, instances):
+        instance_ids = [instance.id for instance in instances]
+        if not instance_ids: return
+
+        self.ec2.instances.filter(InstanceIds=instance_ids).terminate()
+        self.inventory.invalidate()
+
+    @traced
     def ensure_static_key_pair(self):
         self.send_bot("checking key pair")
         key_pair = self.ec2.key_pairs.filter(Filters=[{
@@ -262,246 +991,255 @@ class Deployment(object):
 
         self.key_pair = key_pair
 
+    def compile_security_group_rules(self, sg_rules):
+        # Expand a static_security_group_conf rule list into canonical
+        # (proto, from_port, to_port, kind, value) entries, where kind is
+        # either "cidr" or "group".  Returns (ingress, egress) sets.
+        ingress = set()
+        egress = set()
+        for rule in sg_rules:
+            flow = rule.get("flow", "in")
+            do_ingress = (flow == "sym" or flow == "in")
+            do_egress = (flow == "sym" or flow == "out")
+
+            ports = []
+            port = rule.get("port")
+            if port is not None:
+                try:
+                    for port_entry in port:
+                        try:
+                            from_port, to_port = tuple(port_entry)
+                        except TypeError:
+                            from_port = port_entry
+                            to_port = port_entry
+                        ports.append((from_port, to_port))
+                except TypeError:
+                    ports.append((port, port))
+
+            if not ports:
+                ports.append(None)
+
+            groups = rule.get("groups")
+            if isinstance(groups, basestring) or groups is None:
+                groups = [groups]
+
+            protos = rule.get("proto", "all")
+            if isinstance(protos, basestring):
+                if protos == "all":
+                    protos = ["tcp", "udp", "icmp"]
+                else:
+                    protos = [protos]
+
+            cidr_ip = rule.get("cidr_ip")
+
+            iterator = it.product(ports, groups, protos)
+            for (port_entry, group, proto) in iterator:
+                from_port, to_port = (
+                    2*(-1,) if proto == "icmp" else
+                    (0, (1 << 16) - 1)
+                )
+
+                if port_entry is not None:
+                    from_port, to_port = port_entry
+
+                entries = []
+                if cidr_ip is not None:
+                    entries.append(
+                        (proto, from_port, to_port, "cidr", cidr_ip))
+
+                if group is not None:
+                    entries.append((
+                        proto, from_port, to_port,
+                        "group", self.static_security_groups[group]))
+
+                if do_ingress:
+                    ingress.update(entries)
+
+                if do_egress:
+                    egress.update(entries)
+
+        return ingress, egress
+
+    @staticmethod
+    def canonical_permissions(ip_permissions):
+        # Inverse of ip_permissions(), for IpPermissions as reported by EC2.
+        result = set()
+        for perm in ip_permissions or ():
+            proto = perm["IpProtocol"]
+            from_port = perm.get("FromPort", -1)
+            to_port = perm.get("ToPort", -1)
+
+            for ip_range in perm.get("IpRanges", ()):
+                result.add(
+                    (proto, from_port, to_port, "cidr", ip_range["CidrIp"]))
+
+            for pair in perm.get("UserIdGroupPairs", ()):
+                result.add(
+                    (proto, from_port, to_port, "group", pair["GroupId"]))
+
+        return result
+
+    @staticmethod
+    def ip_permissions(entries):
+        grouped = {}
+        for proto, from_port, to_port, kind, value in sorted(entries):
+            perm = grouped.setdefault((proto, from_port, to_port), {
+                "IpProtocol": proto,
+                "FromPort": from_port,
+                "ToPort": to_port,
+            })
+
+            if kind == "cidr":
+                perm.setdefault("IpRanges", []).append({"CidrIp": value})
+            else:
+                perm.setdefault("UserIdGroupPairs", []).append(
+                    {"GroupId": value})
+
+        return [grouped[key] for key in sorted(grouped)]
+
+    @traced
     def ensure_static_security_groups(self):
         self.send_bot("checking security groups")
-        security_groups = self.ec2.security_groups.filter(Filters=[{
-            "Name": "tag:namespace", "Values": [self.namespace],
-        }]).filter(Filters=[{
-            "Name": "tag:role", "Values": [
-                sg["name"] for sg in self.static_security_group_conf]
-        }]).filter(Filters=[{
-            "Name": "vpc-id", "Values": [self.vpc.id]
-        }])
+
+        fq_names = dict(
+            ("/".join((self.namespace, sg["name"])), sg["name"])
+            for sg in self.static_security_group_conf
+        )
+
+        existing = dict(
+            (sg.group_name, sg)
+            for sg in self.ec2.security_groups.filter(Filters=[
+                {"Name": "vpc-id", "Values": [self.vpc.id]},
+                {"Name": "group-name", "Values": list(fq_names.keys())},
+            ])
+        )
 
         todo_list = []
+        created = []
         for sg in self.static_security_group_conf:
             sg_name = sg["name"]
             sg_rules = sg["rules"]
 
             fq_name = "/".join((self.namespace, sg_name))
-            sub_sg = security_groups.filter(Filters=[{
-                "Name": "group-name", "Values": [fq_name]
-            }])
-
-            new_sg_tuple = tuple(iter(sub_sg))
-            if new_sg_tuple:
-                new_sg = new_sg_tuple[0]
-            else:
+            new_sg = existing.get(fq_name)
+            if new_sg is None:
                 new_sg = self.ec2.create_security_group(
                     GroupName=fq_name,
                     Description="test-description",
                     VpcId=self.vpc.id,
                 )
+                created.append(new_sg.id)
 
             self.static_security_groups[sg_name] = new_sg.id
             todo_list.append((new_sg, sg_name, sg_rules))
 
-        time.sleep(5)
+        if created:
+            self.wait(
+                "security groups to become visible",
+                lambda: self.security_groups_visible(created),
+                timeout=60)
 
         for new_sg, sg_name, sg_rules in todo_list:
-            self.ec2.create_tags(
-                Resources=[new_sg.id],
-                Tags=[
-                    {"Key": "namespace", "Value": self.namespace},
-                    {"Key": "role", "Value": sg_name}
-                ]
-            )
+            tags = new_sg.tags or []
+            if (get_tag(tags, "namespace") != self.namespace or
+                    get_tag(tags, "role") != sg_name):
+                self.ec2.create_tags(
+                    Resources=[new_sg.id],
+                    Tags=[
+                        {"Key": "namespace", "Value": self.namespace},
+                        {"Key": "role", "Value": sg_name}
+                    ]
+                )
 
-            ingress_permissions = []
-            egress_permissions = []
-            for rule in sg_rules:
-                flow = rule.get("flow", "in")
-                do_ingress = (flow == "sym" or flow == "in")
-                do_egress = (flow == "sym" or flow == "out")
-
-                ports = []
-                port = rule.get("port")
-                if port is not None:
-                    try:
-                        for port_entry in port:
-                            try:
-                                from_port, to_port = tuple(port_entry)
-                            except TypeError:
-                                from_port = port_entry
-                                to_port = port_entry
-                            ports.append((from_port, to_port))
-                    except TypeError:
-                        ports.append((port, port))
-
-                if not ports:
-                    ports.append(None)
-
-                groups = rule.get("groups")
-                if isinstance(groups, basestring) or groups is None:
-                    groups = [groups]
-
-                protos = rule.get("proto", "all")
-                if isinstance(protos, basestring):
-                    if protos == "all":
-                        protos = ["tcp", "udp", "icmp"]
-                    else:
-                        protos = [protos]
-
-                iterator = it.product(ports, groups, protos)
-                for (port_entry, group, proto) in iterator:
-                    perm_entry = {}
-                    from_port, to_port = (
-                        2*(-1,) if proto == "icmp" else
-                        (0, (1 << 16) - 1)
-                    )
-
-                    if port_entry is not None:
-                        from_port, to_port = port_entry
-
-                    perm_entry["IpProtocol"] = proto
-                    perm_entry["FromPort"] = from_port
-                    perm_entry["ToPort"] = to_port
-
-                    cidr_ip = rule.get("cidr_ip")
-                    if cidr_ip is not None:
-                        perm_entry["IpRanges"] = [{ "CidrIp": cidr_ip }]
-
-                    if group is not None:
-                        perm_entry["UserIdGroupPairs"] = [{
-                            "GroupId": self.static_security_groups[group],
-                            "VpcId": self.vpc.id
-                        }]
-
-                    if do_ingress:
-                        ingress_permissions.append(perm_entry)
-
-                    if do_egress:
-                        egress_permissions.append(perm_entry)
-
-            new_sg.revoke_ingress(IpPermissions=[{
-                "IpProtocol": "-1",
-                "FromPort": -1,
-                "ToPort": -1,
-                "IpRanges": [{ "CidrIp": "0.0.0.0/0" }]
-            }])
-
-            new_sg.revoke_egress(IpPermissions=[{
-                "IpProtocol": "-1",
-                "FromPort": -1,
-                "ToPort": -1,
-                "IpRanges": [{ "CidrIp": "0.0.0.0/0" }]
-            }])
-
-            for perm in ingress_permissions:
-                try: new_sg.authorize_ingress(IpPermissions=[perm])
-                except botocore.exceptions.ClientError: pass
-
-            for perm in egress_permissions:
-                try: new_sg.authorize_egress(IpPermissions=[perm])
-                except botocore.exceptions.ClientError: pass
+            ingress, egress = self.compile_security_group_rules(sg_rules)
+
+            current_ingress = self.canonical_permissions(
+                new_sg.ip_permissions)
+            current_egress = self.canonical_permissions(
+                new_sg.ip_permissions_egress)
+
+            # authorize first, so that a rule being replaced by an equivalent
+            # one never leaves a window with no access at all
+            if ingress - current_ingress:
+                new_sg.authorize_ingress(IpPermissions=self.ip_permissions(
+                    ingress - current_ingress))
+
+            if egress - current_egress:
+                new_sg.authorize_egress(IpPermissions=self.ip_permissions(
+                    egress - current_egress))
 
+            if current_ingress - ingress:
+                new_sg.revoke_ingress(IpPermissions=self.ip_permissions(
+                    current_ingress - ingress))
+
+            if current_egress - egress:
+                new_sg.revoke_egress(IpPermissions=self.ip_permissions(
+                    current_egress - egress))
+
+    @traced
     def ensure_static_instances(self):
         self.send_bot("checking static instances")
-        instances =  self.ec2.instances.filter(Filters=[{
-            "Name": "tag:namespace", "Values": [self.namespace]
-        }]).filter(Filters=[{
-            "Name": "tag:role", "Values": self.static_instance_conf.keys()
-        }]).filter(Filters=[{
-            "Name": "instance-state-name", "Values": [
-                "pending", "running", "stopping", "stopped"
-            ]
-        }])
 
         journal = []
+        requests = []
         for role, instance in self.static_instance_conf.items():
             count = instance.get("count", 1)
-            i_type = instance.get("type", "t2.nano")
-            volumes = instance.get("volumes", [])
-            groups = instance.get("groups", [])
 
-            subinstances = instances.filter(Filters=[{
-                "Name": "tag:role", "Values": [role],
-            }])
-
-            instance_tuple = tuple(subinstances)
-            journal_entry = list(instance_tuple)
+            instance_tuple = tuple(self.inventory.select(role=role))
+            journal.append((role, list(instance_tuple)))
 
             num_instances = max(count - len(instance_tuple), 0)
-            if num_instances > 0:
-                new_instances = self.ec2.create_instances(
-                    ImageId=self.ami,
-                    KeyName=self.namespace,
-                    InstanceType=i_type,
-                    MinCount=num_instances,
-                    MaxCount=num_instances,
-                    BlockDeviceMappings=[
-                        {
-                            "DeviceName": "xvd" + chr(ord("b") + index),
-                            "Ebs": {
-                                "VolumeSize": volume,
-                                "DeleteOnTermination": True
-                            }
-                        }
-                        for (index, volume) in enumerate(volumes)
-                    ],
-                    SecurityGroupIds=[
-                        self.static_security_groups[group_name]
-                        for group_name in groups
-                    ]
-                )
-
-                journal_entry.extend(new_instances)
-                for instance in new_instances:
-                    instance.wait_until_running()
+            requests.append((role, instance, "static", num_instances, ()))
 
-                self.ec2.create_tags(
-                    Resources=[inst.id for inst in new_instances],
-                    Tags=[
-                        {"Key": "Name",
-                         "Value": "/".join((self.namespace, role))},
-                        {"Key": "namespace", "Value": self.namespace},
-                        {"Key": "role", "Value": role},
-                        {"Key": "state", "Value": "static"}
-                    ]
-                )
-
-            journal.append((role, journal_entry))
+        new_instances = self.provision_instances(requests)
+        for role, instance_list in journal:
+            instance_list.extend(new_instances.get(role, ()))
 
         for role, instance_list in journal:
             for instance in instance_list: instance.wait_until_running()
-            self.instances[role] = list(instances.filter(InstanceIds=[
-                instance.id for instance in instance_list
-            ]))
+            self.instances[role] = self.inventory.get(
+                instance.id for instance in instance_list)
 
+    @traced
     def ensure_dynamic_instances(self, rev="master"):
-        self.send_bot("checking dynamic instances")
-        instances =  self.ec2.instances.filter(Filters=[{
-            "Name": "tag:namespace", "Values": [self.namespace]
-        }]).filter(Filters=[{
-            "Name": "tag:role", "Values": self.dynamic_instance_conf.keys()
-        }]).filter(Filters=[{
-            "Name": "instance-state-name", "Values": [
-                "pending", "running", "stopping", "stopped"
-            ]
-        }])
+        self.prep_dynamic_instances(
+            rev, self.launch_dynamic_instances(rev))
 
-        prestage = False
-        predeploy = False
+    def load_dynamic_instances(self):
         for role in self.dynamic_instance_conf.keys():
-            subinstances = instances.filter(Filters=[{
-                "Name": "tag:role", "Values": [role],
-            }])
-
             self.instances[role] = {
-                state: list(subinstances.filter(Filters=[{
-                    "Name": "tag:state", "Values": [state],
-                }]))
-
+                state: self.inventory.select(role=role, state=state)
                 for state in ("live", "staged", "pending")
             }
 
+    @traced
+    def launch_dynamic_instances(self, rev="master"):
+        # First half of ensure_dynamic_instances: replace missing live or
+        # staged instance sets with new instances, and wait for them to run.
+        # Returns the states that were replaced, for prep_dynamic_instances.
+        self.send_bot("checking dynamic instances")
+        self.load_dynamic_instances()
+
+        prestage = False
+        predeploy = False
+        for role in self.dynamic_instance_conf.keys():
             prestage = (prestage or not self.instances[role]["staged"])
             predeploy = (predeploy or not self.instances[role]["live"])
 
+        # instances an interrupted run launched, but did not finish prepping
+        states = [
+            state for state in ("live", "staged")
+            if not self.journal.done("ready:" + state)
+            and self.journaled_instances(state, dict(
+                (role, self.instances[role][state])
+                for role in self.dynamic_instance_conf.keys()))
+        ]
         for flag, state in ((predeploy, "live"), (prestage, "staged")):
             if not flag: continue
 
             rev, _ = self.check_rev(rev)
+            self.secrets.prefetch()
+            states.append(state)
 
             for role in self.dynamic_instance_conf.keys():
                 instance_entry = self.instances.get(role)
@@ -510,225 +1248,393 @@ class Deployment(object):
                 instances = instance_entry.get(state)
                 if not instances: continue
 
-                self.ec2.instances.filter(InstanceIds=[
-                    instance.id for instance in instances
-                ]).terminate()
-
-            journal = []
-            for role, instance in self.dynamic_instance_conf.items():
-                count = instance.get("count", 1)
-                i_type = instance.get("type", "t2.nano")
-                volumes = instance.get("volumes", [])
-                groups = instance.get("groups", [])
-
-                new_instances = self.ec2.create_instances(
-                    ImageId=self.ami,
-                    KeyName=self.namespace,
-                    InstanceType=i_type,
-                    MinCount=count,
-                    MaxCount=count,
-                    BlockDeviceMappings=[
-                        {
-                            "DeviceName": "xvd" + chr(ord("b") + index),
-                            "Ebs": {
-                                "VolumeSize": volume,
-                                "DeleteOnTermination": True
-                            }
-                        }
-                        for (index, volume) in enumerate(volumes)
-                    ],
-                    SecurityGroupIds=[
-                        self.static_security_groups[group_name]
-                        for group_name in groups
-                    ]
-                )
+                self.terminate_instances(instances)
 
-                for instance in new_instances:
-                    instance.wait_until_running()
+            journal = self.provision_instances([
+                (role, instance, state, instance.get("count", 1), ())
+                for role, instance in self.dynamic_instance_conf.items()
+            ])
 
-                self.ec2.create_tags(
-                    Resources=[inst.id for inst in new_instances],
-                    Tags=[
-                        {"Key": "Name",
-                         "Value": "/".join((self.namespace, role))},
-                        {"Key": "namespace", "Value": self.namespace},
-                        {"Key": "role", "Value": role},
-                        {"Key": "state", "Value": state}
-                    ]
-                )
+            self.wait(
+                "{} instance tags".format(state),
+                lambda: self.tags_visible(
+                    it.chain(*journal.values()), "state", state),
+                timeout=120)
 
-                journal.append((role, new_instances))
+            for role, instance_list in journal.items():
+                for instance in instance_list: instance.wait_until_running()
+                self.instances[role][state] = self.inventory.get(
+                    instance.id for instance in instance_list)
+
+            self.journal.record_instances(state, dict(
+                (role, [instance.id for instance in instance_list])
+                for role, instance_list in journal.items()))
+
+        return states
+
+    def journal_key(self, operation, rev):
+        # A stage resumes only for the same revision; any deploy finishes an
+        # interrupted one (whose fleets may already have been swapped).
+        return operation, rev if operation == "stage" else None
+
+    def journaled_instances(self, state, current):
+        # Whether current (role -> instances in state) are exactly the
+        # instances the journal has for state, all of them still up: left
+        # behind by an interrupted run, and fit to carry on with.
+        recorded = self.journal.instances(state)
+        return bool(recorded) and all(
+            sorted(recorded.get(role, ())) == sorted(
+                instance.id for instance in current.get(role, ()))
+            and all(instance.state["Name"] in ("pending", "running")
+                    for instance in current.get(role, ()))
+            for role in self.dynamic_instance_conf.keys())
+
+    @traced
+    def prep_dynamic_instances(self, rev, states):
+        # Second half of ensure_dynamic_instances: provision the instances
+        # launched by launch_dynamic_instances.  Needs the static hosts to be
+        # provisioned (see rolling_base).
+        if not states: return
+
+        rev, _ = self.check_rev(rev)
+        for state in states:
+            if not self.journal.done("prep:" + state):
+                self.prep_state(rev, state)
+                self.journal.mark("prep:" + state)
+
+            self.associate_address(
+                self.production_ip if state == "live" else self.staging_ip,
+                self.instances["web"][state][0]
+            )
 
-            time.sleep(5)
+            with self.tagging() as tags:
+                for role, entry in self.instances.items():
+                    if not isinstance(entry, dict): continue
+                    tags.add(
+                        [instance.id for instance in entry.get(state, ())],
+                        [{"Key": "revision", "Value": rev}])
 
-            for role, instance_list in journal:
-                for instance in instance_list: instance.wait_until_running()
-                self.instances[role][state] = list(
-                    self.ec2.instances.filter(InstanceIds=[
-                        instance.id for instance in instance_list
-                    ])
-                )
+            self.inventory.invalidate()
+            self.journal.mark("ready:" + state)
 
-            self.run_play(
-                "prep-inventory",
-                "prep.yml",
-                {
-                    "web": (("web", state),),
-                    "worker": (("worker", state),),
-                    "db": ("p/db",) if state == "live" else ("s/db+mq",),
-                    "queue": ("p/queue",) if state == "live" else ("s/db+mq",),
-                    "dynamic": (("web", state), ("worker", state))
-                },
-                {
-                    "revision": rev,
-                    "admin_name": self.admin_name,
-                    "admin_pass": self.admin_pass,
-                    "public_name": self.public_name,
-                    "deploy_mode": (
-                        "production" if state == "live" else "staging"),
-                    "s3_bucket": (
-                        self.s3_production_bucket
-                        if state == "live" else
-                        self.s3_staging_bucket),
-                    "aws_access_key_id": self.aws_access_key_id,
-                    "aws_secret_access_key": self.aws_secret_access_key,
-                    "ssl_cert": self.ssl_cert,
-                    "ssl_chain": self.ssl_chain,
-                    "ssl_dhparams": self.ssl_dhparams,
-                    "ssl_key": self.ssl_key,
-                }
-            )
+    def prep_state(self, rev, state):
+        release = self.ensure_release(rev, (("web", state),))
 
-            next(iter(
-                self.ec2.vpc_addresses.filter(PublicIps=[
-                    self.production_ip
-                    if state == "live" else
-                    self.staging_ip
-                ])
-            )).associate(
-                InstanceId=self.instances["web"][state][0].id
-            )
+        playbooks, fragments = self.prep_playbooks({
+            "web": (("web", state),),
+            "worker": (("worker", state),),
+            "db": ("p/db",) if state == "live" else ("s/db+mq",),
+            "queue": ("p/queue",) if state == "live" else ("s/db+mq",),
+            "dynamic": (("web", state), ("worker", state))
+        })
 
-            for role, entry in self.instances.items():
-                if not isinstance(entry, dict): continue
-                for instance in entry.get(state, ()):
-                    instance.create_tags(Tags=[
-                        {"Key": "revision", "Value": rev},
-                    ])
+        self.run_play(
+            "prep-inventory",
+            playbooks,
+            fragments,
+            {
+                "revision": rev,
+                "release_artifact": release,
+                "package_cache": self.package_cache_address(),
+                "admin_name": self.admin_name,
+                "admin_pass": self.admin_pass,
+                "public_name": self.public_name,
+                "deploy_mode": (
+                    "production" if state == "live" else "staging"),
+                "s3_bucket": (
+                    self.s3_production_bucket
+                    if state == "live" else
+                    self.s3_staging_bucket),
+                "aws_access_key_id": self.aws_access_key_id,
+                "aws_secret_access_key": self.aws_secret_access_key,
+                "ssl_cert": self.ssl_cert,
+                "ssl_chain": self.ssl_chain,
+                "ssl_dhparams": self.ssl_dhparams,
+                "ssl_key": self.ssl_key,
+            }
+        )
 
-    def open_security(self):
+    def set_temp_security(self, instances, enabled):
         static_sg = self.static_security_groups["temp"]
 
-        for instance in self.ec2.instances.filter(Filters=[{
-                    "Name": "tag:namespace", "Values": [self.namespace]
-                }]).filter(Filters=[{
-                    "Name": "instance-state-name", "Values": [
-                        "pending", "running", "stopping", "stopped"
-                    ]
-                }]):
+        def modify(instance):
             security_groups = [sg["GroupId"] for sg in instance.security_groups]
-            need_temp = all(sg != static_sg for sg in security_groups)
+            has_temp = static_sg in security_groups
 
-            if need_temp:
-                self.ec2.meta.client.modify_instance_attribute(
-                    InstanceId=instance.id,
-                    Groups=security_groups + [static_sg])
+            if enabled and not has_temp:
+                groups = security_groups + [static_sg]
+            elif has_temp and not enabled:
+                groups = [sg for sg in security_groups if sg != static_sg]
+            else:
+                return False
 
-    def close_security(self):
-        static_sg = self.static_security_groups["temp"]
+            self.ec2.meta.client.modify_instance_attribute(
+                InstanceId=instance.id, Groups=groups)
+            return True
 
-        for instance in self.ec2.instances.filter(Filters=[{
-                    "Name": "tag:namespace", "Values": [self.namespace]
-                }]).filter(Filters=[{
-                    "Name": "instance-state-name", "Values": [
-                        "pending", "running", "stopping", "stopped"
-                    ]
-                }]):
-            security_groups = [sg["GroupId"] for sg in instance.security_groups]
-            remove_temp = any(sg == static_sg for sg in security_groups)
+        changed = sum(parallel_map(
+            modify, instances, max_workers=16, tracer=self.tracer))
+        if changed:
+            self.inventory.invalidate()
+
+        return changed
+
+    @traced
+    def open_security(self):
+        self.join_background()
+
+        instances = self.inventory.select()
+        self.set_temp_security(instances, True)
+        self.secured_ids.update(instance.id for instance in instances)
+
+    @traced
+    def close_security(self, wait=True):
+        # Instances launched while the context was open were given the temp
+        # group directly (see launch_instances) and are tracked by id, so they
+        # are closed even if their tags are not yet visible to the snapshot.
+        instances = dict(
+            (instance.id, instance) for instance in self.inventory.select())
+        instances.update(
+            (instance.id, instance)
+            for instance in self.inventory.get(
+                instance_id for instance_id in self.secured_ids
+                if instance_id not in instances
+            )
+            if instance.state["Name"] in Inventory.LIVE_STATES
+        )
+        self.secured_ids.clear()
+
+        instances = [instances[key] for key in sorted(instances)]
+        if wait:
+            self.set_temp_security(instances, False)
+            return
 
-            if remove_temp:
-                self.ec2.meta.client.modify_instance_attribute(
-                    InstanceId=instance.id,
-                    Groups=[sg for sg in security_groups if sg != static_sg])
+        self.in_background(self.set_temp_security, instances, False)
+
+    def in_background(self, func, *args):
+        # Run func(*args) on a thread of its own.  join_background() waits
+        # for it, and raises what it raised.
+        errors = []
+
+        def run():
+            try:
+                func(*args)
+            except Exception as e:
+                traceback.print_exc()
+                sys.stderr.flush()
+                errors.append(e)
+
+        thread = threading.Thread(target=self.tracer.wrap(run))
+        thread.start()
+        self.background.append((thread, errors))
+
+    def join_background(self):
+        # Wait for every background job, then raise the first error among
+        # them, if any.
+        errors = []
+        while self.background:
+            thread, thread_errors = self.background.pop(0)
+            thread.join()
+            errors.extend(thread_errors)
+
+        if errors:
+            raise errors[0]
 
     @contextmanager
-    def security(self):
+    def security(self, wait=True):
         if self.security_count == 0:
             self.open_security()
 
         self.security_count += 1
-        yield
+        try:
+            yield
+        finally:
+            self.security_count -= 1
+            if self.security_count == 0:
+                self.close_security(wait=wait)
+
+    def git(self, *args, **kwds):
+        cwd = kwds.get("cwd", self.submodule)
+        if kwds.get("check_output"):
+            return sp.check_output(
+                ("git",) + args, cwd=cwd, stderr=_DEVNULL).decode("utf-8")
+
+        return sp.call(
+            ("git",) + args, cwd=cwd, stdout=_DEVNULL, stderr=_DEVNULL) == 0
+
+    def has_commit(self, sha):
+        return self.git("cat-file", "-e", sha + "^{commit}")
+
+    def resolve_rev(self, rev="master"):
+        # Map a ref name (branch, tag, or sha) to a full commit sha, touching
+        # the network as little as possible:
+        #
+        #   - full shas that are already present locally need no network
+        #   - otherwise, ask the remote with ls-remote and shallow-fetch just
+        #     that ref if its commit is missing locally
+        #   - anything ls-remote does not know (e.g.: abbreviated shas) falls
+        #     back to a full fetch
+        #
+        # The work tree is left alone: submitters resolve revisions while the
+        # queue's runner may be checking another one out (see
+        # release_source).  Results are memoized for the lifetime of the
+        # Deployment.
+        sha = self.rev_cache.get(rev)
+        if sha is not None:
+            return sha
+
+        if not os.path.exists(os.path.join(self.submodule, ".git")):
+            self.git(
+                "submodule", "update", "--init", self.submodule, cwd=None)
+
+        if _FULL_SHA.match(rev) and self.has_commit(rev):
+            sha = rev
+        else:
+            remote_refs = {}
+            for line in self.git(
+                    "ls-remote", "origin", rev, rev + "^{}",
+                    check_output=True).splitlines():
+                ref_sha, ref_name = line.split("\t", 1)
+                remote_refs[ref_name] = ref_sha
+
+            ref_name = next((
+                name for name in (
+                    "refs/heads/" + rev,
+                    "refs/tags/" + rev + "^{}",
+                    "refs/tags/" + rev,
+                    rev,
+                )
+                if name in remote_refs
+            ), None)
+
+            if ref_name is not None:
+                sha = remote_refs[ref_name]
+                if not self.has_commit(sha):
+                    if ref_name.endswith("^{}"):
+                        ref_name = ref_name[:-3]
+                    self.git("fetch", "--depth", "1", "origin", ref_name)
+
+                # never fall back to a stale local ref of the same name
+                if not self.has_commit(sha):
+                    raise RuntimeError("could not fetch {} ({})".format(
+                        rev, sha))
+            else:
+                self.git("fetch", "--all")
+
+            if sha is None:
+                sha = self.git(
+                    "rev-parse", "--verify", "--no-flags", rev + "^{commit}",
+                    check_output=True).strip()
+
+        self.rev_cache[rev] = sha
+        self.rev_cache[sha] = sha
+        return sha
+
+    @traced
+    def release_source(self, sha):
+        # Check sha (and its submodules) out in the local clone, and pack the
+        # working tree for the release build.
+        path = os.path.join("scratch", "releases", sha + "-src.tar.gz")
+        if os.path.exists(path):
+            return path
+
+        for args in (("checkout", "--quiet", "--force", "--detach", sha),
+                     ("submodule", "update", "--init", "--recursive")):
+            sp.check_call(
+                ("git",) + args,
+                cwd=self.submodule,
+                stdout=_DEVNULL,
+                stderr=_DEVNULL,
+            )
 
-        self.security_count -= 1
-        if self.security_count == 0:
-            self.close_security()
+        head = self.git("rev-parse", "HEAD", check_output=True).strip()
+        if head != sha:
+            raise RuntimeError("checked out {} instead of {}".format(
+                head, sha))
 
-    def check_rev(self, rev="master"):
-        submodule = "osumo-project"
+        def exclude_git(info):
+            if os.path.basename(info.name) == ".git":
+                return None
+            return info
 
-        sp.check_call(
-            ["git", "submodule", "update", "--init", submodule],
-            stdout=_DEVNULL,
-            stderr=_DEVNULL,
-        )
+        tmp_path = path + ".tmp"
+        try:
+            with tarfile.open(tmp_path, "w:gz") as archive:
+                archive.add(self.submodule, arcname="osumo-project",
+                            filter=exclude_git)
+        except Exception:
+            try: os.remove(tmp_path)
+            except OSError: pass
+            raise
+
+        os.rename(tmp_path, path)
+        return path
+
+    @traced
+    def ensure_release(self, sha, build_fragment):
+        # Returns the path of the release artifact for sha: the source tree
+        # with a wheelhouse of its python dependencies, the prebuilt web
+        # client and the installed osumo plugin, built once by release.yml on
+        # the (single) host in build_fragment.  Artifacts are cached in
+        # scratch/releases and in the staging bucket, by sha.
+        import boto3.exceptions
+        import botocore.exceptions
+
+        release_dir = os.path.join("scratch", "releases")
+        try: os.makedirs(release_dir)
+        except OSError: pass
 
-        sp.check_call(
-            ["git", "fetch", "--all"],
-            cwd=submodule,
-            stdout=_DEVNULL,
-            stderr=_DEVNULL,
-        )
+        path = os.path.abspath(os.path.join(release_dir, sha + ".tar.gz"))
+        if os.path.exists(path):
+            return path
 
-        sp.check_call(
-            ["git", "checkout", rev],
-            cwd=submodule,
-            stdout=_DEVNULL,
-            stderr=_DEVNULL,
-        )
+        key = _RELEASE_PREFIX + sha + ".tar.gz"
+        try:
+            self.s3.download_file(self.s3_staging_bucket, key, path + ".tmp")
+        except botocore.exceptions.ClientError:
+            pass
+        else:
+            os.rename(path + ".tmp", path)
+            self.send_bot("using cached release for {}".format(sha[:10]))
+            return path
 
-        is_branch = (
-            sp.check_output(
-                ["git", "status", "--branch", "--porcelain"],
-                cwd=submodule,
-                stderr=_DEVNULL,
-            ).split("\n")[0] != "## HEAD (no branch)"
+        # the build runs the dependency layer's tools (pip, nvm): install it
+        # first on a builder that was not launched with it.  The builder is
+        # about to be prepped, which then leaves it alone (see has_deps).
+        deps = self.deps_fragment(build_fragment)
+
+        self.send_bot("building release for {}".format(sha[:10]))
+        self.run_play(
+            "release-inventory",
+            (["deps.yml"] if deps else []) + ["release.yml"],
+            {
+                "build": build_fragment,
+                "dynamic": build_fragment,
+                "deps": deps,
+            },
+            {
+                "revision": sha,
+                "package_cache": self.package_cache_address(),
+                "release_source": os.path.abspath(self.release_source(sha)),
+                "release_artifact": path + ".tmp",
+            }
         )
+        os.rename(path + ".tmp", path)
+        self.record_deps(self.generate_inventory_group(deps))
 
-        if is_branch:
-            sp.check_call(
-                ["git", "pull"],
-                cwd=submodule,
-                stdout=_DEVNULL,
-                stderr=_DEVNULL,
-            )
+        try:
+            self.s3.upload_file(path, self.s3_staging_bucket, key)
+        except (botocore.exceptions.ClientError,
+                boto3.exceptions.S3UploadFailedError) as e:
+            self.send_bot("could not cache release in s3: {}".format(e))
 
-        rev = sp.check_output(
-            ["git", "rev-parse", "--no-flags", rev],
-            cwd=submodule,
-            stderr=_DEVNULL,
-        )[:-1]
+        return path
 
-        sp.check_call(
-            ["git", "checkout", rev],
-            cwd=submodule,
-            stdout=_DEVNULL,
-            stderr=_DEVNULL,
-        )
+    @traced
+    def check_rev(self, rev="master"):
+        rev = self.resolve_rev(rev)
 
-        staged_web = list(
-            self.ec2.instances.filter(Filters=[{
-                "Name": "tag:namespace", "Values": [self.namespace],
-            }]).filter(Filters=[{
-                "Name": "tag:role", "Values": ["web"],
-            }]).filter(Filters=[{
-                "Name": "instance-state-name", "Values": [
-                    "pending", "running", "stopping", "stopped"
-                ]
-            }]).filter(Filters=[{
-                "Name": "tag:state", "Values": ["staged"]
-            }])
-        )
+        staged_web = self.inventory.select(role="web", state="staged")
 
         already_staged = False
         if staged_web:
@@ -737,10 +1643,308 @@ class Deployment(object):
 
         return rev, already_staged
 
-    def generate_inventory_fragment_iterator(self, group, keys, env):
-        if group is not None:
-            yield "[{}]".format(group)
+    @traced
+    def status(self, ports=(22, 80, 443, 8080)):
+        roles = (
+            list(self.dynamic_instance_conf.keys()) +
+            list(self.static_instance_conf.keys())
+        )
+
+        instances = self.inventory.select(role=roles)
+
+        addresses = {}
+        ip_names = (
+            ("production_ip", self.production_ip),
+            ("staging_ip", self.staging_ip),
+        )
+        response = self.ec2.meta.client.describe_addresses(
+            PublicIps=[ip for _, ip in ip_names])
+        for name, ip in ip_names:
+            address = next((
+                entry for entry in response.get("Addresses", ())
+                if entry.get("PublicIp") == ip
+            ), {})
+            addresses[name] = {
+                "ip": ip,
+                "instance_id": address.get("InstanceId"),
+            }
+
+        def probe(job):
+            instance, port = job
+            host = instance.public_ip_address
+            if port == 8080 and get_tag(instance.tags or [], "role") == "web":
+                return probe_girder(host, port) is not None
+            return probe_port(host, port)
+
+        jobs = [
+            (instance, port)
+            for instance in instances
+            if instance.public_ip_address
+            for port in ports
+        ]
+        results = dict(
+            ((instance.id, port), result)
+            for (instance, port), result
+                in zip(jobs, parallel_map(
+                    probe, jobs, max_workers=32, tracer=self.tracer))
+        )
+
+        report = {"roles": {}, "addresses": addresses}
+        for role in roles:
+            report["roles"][role] = {}
+
+        for instance in instances:
+            tags = instance.tags or []
+            entry = {
+                "id": instance.id,
+                "instance_state": instance.state["Name"],
+                "public_ip": instance.public_ip_address,
+                "private_ip": instance.private_ip_address,
+                "revision": get_tag(tags, "revision"),
+                "elastic_ip": [
+                    name for name, address in sorted(addresses.items())
+                    if address["instance_id"] == instance.id
+                ],
+                "ports": dict(
+                    (str(port), results.get((instance.id, port), False))
+                    for port in ports
+                ),
+            }
+
+            # an instance can be caught between launch and tagging
+            report["roles"][get_tag(tags, "role")].setdefault(
+                get_tag(tags, "state", "untagged"), []).append(entry)
+
+        return report
+
+    def deps_fingerprint(self):
+        # Identifies the dependency layer of the dynamic hosts: the base AMI
+        # plus deps.yml (which carries its own package lists), with the
+        # playbooks it includes and the files they copy.
+        digest = hashlib.sha256()
+        digest.update(self.ami.encode("utf-8"))
+        hash_files(digest, playbook_files(["deps.yml"]))
+
+        return digest.hexdigest()
+
+    def golden_image(self):
+        fingerprint = self.deps_fingerprint()
+        if fingerprint not in self._golden_image:
+            self._golden_image[fingerprint] = next(iter(
+                self.ec2.images.filter(Owners=["self"], Filters=[
+                    {"Name": "tag:namespace", "Values": [self.namespace]},
+                    {"Name": "tag:deps-fingerprint", "Values": [fingerprint]},
+                    {"Name": "state", "Values": ["available"]},
+                ])
+            ), None)
+
+        return self._golden_image[fingerprint]
+
+    def forget_lookups(self):
+        # Drop memoized revisions and golden images, for a Deployment that
+        # outlives one operation (the daemon's): branches move, and images
+        # get baked out of band.
+        self.rev_cache.clear()
+        self._golden_image.clear()
+
+    @traced
+    def bake_image(self):
+        fingerprint = self.deps_fingerprint()
+        image = self.golden_image()
+        if image is not None:
+            self.send_bot("image {} already baked for {}".format(
+                image.id, fingerprint[:12]))
+            return image
+
+        self.send_bot("baking image for {}".format(fingerprint[:12]))
+
+        builders = self.provision_instances([
+            ("builder", self.builder_instance_conf, "builder", 1, ("temp",))
+        ])["builder"]
+
+        try:
+            for instance in builders: instance.wait_until_running()
+            self.instances["builder"] = self.inventory.get(
+                instance.id for instance in builders)
+
+            self.run_play("bake-inventory", "deps.yml", {
+                "dynamic": ("builder",),
+                "deps": ("builder",),
+            }, {
+                "package_cache": self.package_cache_address(),
+            })
+
+            image = self.instances["builder"][0].create_image(
+                Name="/".join((self.namespace, "deps", fingerprint[:16])),
+                Description="dependency layer for dynamic {} hosts".format(
+                    self.namespace)
+            )
+
+            self.ec2.meta.client.get_waiter("image_available").wait(
+                ImageIds=[image.id])
+
+            image.create_tags(Tags=[
+                {"Key": "Name",
+                 "Value": "/".join((self.namespace, "deps"))},
+                {"Key": "namespace", "Value": self.namespace},
+                {"Key": "deps-fingerprint", "Value": fingerprint},
+            ])
+        finally:
+            self.instances.pop("builder", None)
+            self.terminate_instances(builders)
+
+        image.reload()
+        self._golden_image[fingerprint] = image
+        self.send_bot("baked image {}".format(image.id))
+        return image
+
+    def has_deps(self, instances):
+        # The dependency layer only needs to be installed on instances that
+        # were not launched from the current golden image and have not been
+        # given it since (warm pool instances and release builders carry the
+        # fingerprint of the layer they have; see record_deps).
+        golden = self.golden_image()
+        fingerprint = self.deps_fingerprint()
+        return all(
+            instance.id in self.deps_installed or
+            (golden is not None and instance.image_id == golden.id) or
+            get_tag(instance.tags or [], "deps-fingerprint") == fingerprint
+            for instance in instances
+        )
+
+    def record_deps(self, instances):
+        # Remember that deps.yml has run on instances, in a tag too so that a
+        # resumed run knows as well.
+        instance_ids = [instance.id for instance in instances]
+        if not instance_ids: return
+
+        self.deps_installed.update(instance_ids)
+        with self.tagging() as tags:
+            tags.add(instance_ids, [
+                {"Key": "deps-fingerprint", "Value": self.deps_fingerprint()}])
+
+    def deps_fragment(self, fragment):
+        # the keys of inventory fragment whose instances lack the dependency
+        # layer
+        return tuple(
+            key for key in fragment
+            if not self.has_deps(self.generate_inventory_group((key,))))
+
+    def prep_playbooks(self, fragments):
+        # The playbooks and inventory fragments that prep the dynamic hosts
+        # in fragments: prep.yml, after deps.yml on those that need it.
+        deps = self.deps_fragment(fragments["dynamic"])
+        return ((["deps.yml"] if deps else []) + ["prep.yml"],
+                dict(fragments, deps=deps))
+
+    def warm_candidates(self):
+        # The warm pool instances claim_warm_instances would take: those
+        # prepared from the current dependency layer.  Returns role ->
+        # instances.
+        fingerprint = self.deps_fingerprint()
+
+        candidates = {}
+        for role, conf in self.dynamic_instance_conf.items():
+            if not conf.get("warm"): continue
+            candidates[role] = [
+                instance
+                for instance in self.inventory.select(role=role, state="warm")
+                if instance.state["Name"] in ("running", "stopped")
+                and get_tag(instance.tags or [], "deps-fingerprint") ==
+                    fingerprint
+            ][:conf.get("count", 1)]
+
+        return candidates
+
+    def claim_warm_instances(self):
+        # Take instances out of the warm pool for staging: retag them as
+        # pending and start the stopped ones.  Returns role -> instances.
+        claimed = self.warm_candidates()
+
+        instances = list(it.chain(*claimed.values()))
+        if not instances:
+            return claimed
+
+        self.send_bot("claiming {} warm instance(s)".format(len(instances)))
+        with self.tagging() as tags:
+            tags.add([instance.id for instance in instances],
+                     [{"Key": "state", "Value": "pending"}])
+
+        stopped = [instance.id for instance in instances
+                   if instance.state["Name"] == "stopped"]
+        if stopped:
+            self.ec2.meta.client.start_instances(InstanceIds=stopped)
+
+        if self.security_count > 0:
+            self.set_temp_security(instances, True)
+            self.secured_ids.update(instance.id for instance in instances)
+
+        self.inventory.invalidate()
+        return claimed
+
+    @traced
+    def replenish_warm_pool(self, wait=True):
+        # Top the warm pool back up to its configured size, replacing members
+        # prepared from an outdated dependency layer.  With wait=False, the
+        # new instances are launched (and stopped) in the background; see
+        # join_background().
+        if not any(conf.get("warm")
+                   for conf in self.dynamic_instance_conf.values()):
+            return
+
+        golden = self.golden_image()
+        if golden is None:
+            self.send_bot("no baked image: not replenishing the warm pool")
+            return
 
+        fingerprint = self.deps_fingerprint()
+
+        stale = []
+        requests = []
+        for role, conf in self.dynamic_instance_conf.items():
+            warm = conf.get("warm")
+            if not warm: continue
+
+            pool = []
+            for instance in self.inventory.select(role=role, state="warm"):
+                if get_tag(instance.tags or [], "deps-fingerprint") == (
+                        fingerprint):
+                    pool.append(instance)
+                else:
+                    stale.append(instance)
+
+            shortfall = warm["count"] - len(pool)
+            if shortfall > 0:
+                requests.append((role, conf, "warm", shortfall, ()))
+
+        self.terminate_instances(stale)
+        if not requests:
+            return
+
+        if wait:
+            self.fill_warm_pool(requests)
+            return
+
+        self.in_background(self.fill_warm_pool, requests)
+
+    def fill_warm_pool(self, requests):
+        # tagged along with state=warm, so that no instance is ever in the
+        # pool without the fingerprint that says what it was prepared from
+        launched = self.provision_instances(requests, tags=[
+            {"Key": "deps-fingerprint", "Value": self.deps_fingerprint()}])
+
+        to_stop = [
+            instance.id
+            for role, instances in launched.items()
+            if self.dynamic_instance_conf[role]["warm"].get("stop")
+            for instance in instances
+        ]
+        if to_stop:
+            self.ec2.meta.client.stop_instances(InstanceIds=to_stop)
+
+        self.send_bot("warm pool replenished")
+
+    def generate_inventory_group(self, keys):
         for key in keys:
             try: key, subkey = key
             except (TypeError, ValueError): subkey = None
@@ -749,50 +1953,209 @@ class Deployment(object):
             if subkey is not None:
                 instances = instances[subkey]
 
-            yield "\n".join(
-                "{} ansible_ssh_private_key_file={} aws_private_ip={}".format(
-                    instance.public_ip_address,
-                    self.ssh_key_path,
-                    instance.private_ip_address,
-                )
-                for instance in instances
-            )
+            for instance in instances:
+                yield instance
 
-        yield ""
+    def generate_inventory(self, fragments, env):
+        inventory = {"_meta": {"hostvars": {}}}
+        hostvars = inventory["_meta"]["hostvars"]
 
-    def generate_inventory_fragment(self, group, keys, env, inventory_dir):
-        group_vars_dir = os.path.join(inventory_dir, "group_vars")
+        for group, keys in fragments.items():
+            hosts = []
+            for instance in self.generate_inventory_group(keys):
+                hosts.append(instance.public_ip_address)
+                hostvars[instance.public_ip_address] = {
+                    "ansible_ssh_private_key_file": self.ssh_key_path,
+                    "aws_private_ip": instance.private_ip_address,
+                }
 
-        try: os.mkdir(group_vars_dir)
-        except OSError: pass
+            inventory[group] = {"hosts": hosts, "vars": env}
+
+        return inventory
+
+    def package_cache_address(self):
+        # Private address of the package cache instance (see cache.yml), or
+        # "" if there is none running; the playbooks then go upstream.
+        instances = self.instances.get("cache")
+        if instances is None:
+            instances = self.inventory.select(role="cache")
+
+        for instance in instances:
+            if instance.state["Name"] == "running":
+                return instance.private_ip_address
+
+        return ""
+
+    def base_fingerprint(self, role):
+        # Identifies what rolling_base would do to the instances of role: the
+        # playbooks with everything they read (included playbooks, templates,
+        # ansible's configuration and roles) and the groups the role is in.
+        digest = hashlib.sha256()
+        hash_files(digest, playbook_files(["base.yml", "cache.yml"]))
+        hash_files(digest, _ANSIBLE_PATHS)
+
+        for group, roles in sorted(self.base_groups.items()):
+            if role in roles:
+                digest.update("{}\n".format(group).encode("utf-8"))
+
+        return digest.hexdigest()
+
+    @traced
+    def rolling_base(self, force=False):
+        # Run the base playbooks against the static instances, skipping the
+        # roles whose instances are all tagged with a matching
+        # base-fingerprint (unless force is set).  A role without instances
+        # counts as changed.  The static resources must already exist (see
+        # ensure_static_resources).
+        fingerprints = {}
+        for role in self.static_instance_conf:
+            fingerprint = self.base_fingerprint(role)
+            if force or not self.instances[role] or any(
+                    get_tag(instance.tags or [], "base-fingerprint") != (
+                        fingerprint)
+                    for instance in self.instances[role]):
+                fingerprints[role] = fingerprint
+
+        if not fingerprints:
+            self.send_bot("base services unchanged")
+            return
 
-        if group is not None:
-            vars_file = os.path.join(group_vars_dir, group)
-            json.dump(env, open(vars_file, "w"))
+        self.send_bot("provisioning base services: {}".format(
+            ", ".join(sorted(fingerprints))))
 
-        return "\n".join(
-            self.generate_inventory_fragment_iterator(group, keys, env))
+        self.run_play(
+            "base-inventory",
+            ["base.yml", "cache.yml"],
+            dict(
+                (group, tuple(role for role in roles if role in fingerprints))
+                for group, roles in self.base_groups.items()
+            )
+        )
 
-    def rolling_base(self):
-        self.ensure_static_resources()
-        self.send_bot("provisioning base services")
+        with self.tagging() as tags:
+            for role, fingerprint in fingerprints.items():
+                tags.add(
+                    [instance.id for instance in self.instances[role]],
+                    [{"Key": "base-fingerprint", "Value": fingerprint}])
+
+    def stage_env(self, rev):
+        return {
+            "revision": rev,
+            "package_cache": self.package_cache_address(),
+            "admin_name": self.admin_name,
+            "admin_pass": self.admin_pass,
+            "public_name": self.public_name,
+            "deploy_mode": "staging",
+            "s3_bucket": self.s3_staging_bucket,
+            "aws_access_key_id": self.aws_access_key_id,
+            "aws_secret_access_key": self.aws_secret_access_key,
+            "ssl_cert": self.ssl_cert,
+            "ssl_chain": self.ssl_chain,
+            "ssl_dhparams": self.ssl_dhparams,
+            "ssl_key": self.ssl_key,
+        }
 
+    def stage_fingerprint(self, env):
+        # Identifies everything a staged host was provisioned with except for
+        # the osumo-project revision: the dependency layer, the prep playbook
+        # with its templates and scripts, and the variables it was run with.
+        digest = hashlib.sha256()
+        digest.update(self.deps_fingerprint().encode("utf-8"))
+
+        paths = [os.path.join("files", "playbooks", "prep.yml")]
+        for directory in ("templates", "scripts"):
+            root = os.path.join("files", directory)
+            paths.extend(
+                os.path.join(root, name) for name in sorted(os.listdir(root))
+                if os.path.isfile(os.path.join(root, name)))
+
+        for path in paths:
+            digest.update(path.encode("utf-8"))
+            with open(path, "rb") as f:
+                digest.update(f.read())
+
+        for key, value in sorted(env.items()):
+            if key == "revision": continue
+            digest.update("{}={}\n".format(key, value).encode("utf-8"))
+
+        return digest.hexdigest()
+
+    def can_stage_in_place(self, fingerprint, staged):
+        # Whether the staged instances can be moved to a new revision without
+        # reprovisioning them: everything else they were staged with is
+        # unchanged.  Instances that have been live since were reconfigured
+        # for production, and have lost their stage-fingerprint tag (see
+        # rolling_deploy).  staged: role -> staged instances.
+        for role, conf in self.dynamic_instance_conf.items():
+            instances = staged.get(role) or []
+            if len(instances) != conf.get("count", 1):
+                return False
+
+            for instance in instances:
+                if instance.state["Name"] != "running":
+                    return False
+
+                if get_tag(instance.tags or [], "stage-fingerprint") != (
+                        fingerprint):
+                    return False
+
+        return True
+
+    def stage_in_place(self, rev):
+        self.send_bot("only the revision changed: updating in place")
+        release = self.ensure_release(rev, (("web", "staged"),))
         self.run_play(
-            "base-inventory",
-            "base.yml",
+            "update-inventory",
+            "update.yml",
             {
-                "db": ("s/db+mq", "p/db"),
-                "mq": ("s/db+mq", "p/queue"),
-                "stage": ("s/db+mq", ),
-                "prod": ("p/queue", ),
-            }
+                "web": (("web", "staged"),),
+                "worker": (("worker", "staged"),),
+                "dynamic": (("web", "staged"), ("worker", "staged"))
+            },
+            {"revision": rev, "release_artifact": release}
         )
 
+        with self.tagging() as tags:
+            for role in self.dynamic_instance_conf.keys():
+                tags.add(
+                    [instance.id for instance in self.instances[role]["staged"]],
+                    [{"Key": "revision", "Value": rev}])
+
+        self.inventory.invalidate()
+
+    @traced
     def rolling_stage(self, rev="master"):
+        self.finish_stage(self.launch_stage(rev))
+
+    @traced
+    def launch_stage(self, rev="master"):
+        # First half of rolling_stage: launch the pending instances (unless
+        # the staged ones can be updated in place), and wait for them to run.
+        # Returns the plan for finish_stage.
         rev, already_staged = self.check_rev(rev)
         self.send_bot("staging revision: {}".format(rev))
+        self.secrets.prefetch()
+
+        env = self.stage_env(rev)
+        fingerprint = self.stage_fingerprint(env)
+        plan = {
+            "revision": rev,
+            "env": env,
+            "fingerprint": fingerprint,
+            "in_place": self.can_stage_in_place(fingerprint, dict(
+                (role, self.instances.get(role, {}).get("staged"))
+                for role in self.dynamic_instance_conf.keys())),
+        }
+        if plan["in_place"]:
+            return plan
+
+        if self.journaled_instances("pending", dict(
+                (role, self.instances[role]["pending"])
+                for role in self.dynamic_instance_conf.keys())):
+            self.send_bot("carrying on with the pending instances of the "
+                          "interrupted run")
+            return plan
 
-        instance_query = None
         for role in self.dynamic_instance_conf.keys():
             instance_entry = self.instances.get(role)
             if not instance_entry: continue
@@ -800,128 +2163,103 @@ class Deployment(object):
             pending_instances = instance_entry.get("pending")
             if not pending_instances: continue
 
-            if instance_query is None:
-                instance_query = self.ec2.instances.filter(Filters=[{
-                    "Name": "tag:namespace", "Values": [self.namespace]
-                }]).filter(Filters=[{
-                    "Name": "tag:role",
-                        "Values": self.dynamic_instance_conf.keys()
-                }]).filter(Filters=[{
-                    "Name": "instance-state-name", "Values": [
-                        "pending", "running", "stopping", "stopped"
-                    ]
-                }])
-
-            instance_query.filter(InstanceIds=[
-                instance.id for instance in pending_instances
-            ]).terminate()
+            self.terminate_instances(pending_instances)
 
-        journal = []
-        for role, instance in self.dynamic_instance_conf.items():
-            count = instance.get("count", 1)
-            i_type = instance.get("type", "t2.nano")
-            volumes = instance.get("volumes", [])
-            groups = instance.get("groups", [])
-
-            new_instances = self.ec2.create_instances(
-                ImageId=self.ami,
-                KeyName=self.namespace,
-                InstanceType=i_type,
-                MinCount=count,
-                MaxCount=count,
-                BlockDeviceMappings=[
-                    {
-                        "DeviceName": "xvd" + chr(ord("b") + index),
-                        "Ebs": {
-                            "VolumeSize": volume,
-                            "DeleteOnTermination": True
-                        }
-                    }
-                    for (index, volume) in enumerate(volumes)
-                ],
-                SecurityGroupIds=[
-                    self.static_security_groups[group_name]
-                    for group_name in (groups + ["temp"])
-                ]
-            )
-
-            for instance in new_instances:
-                instance.wait_until_running()
-
-            self.ec2.create_tags(
-                Resources=[inst.id for inst in new_instances],
-                Tags=[
-                    {"Key": "Name",
-                     "Value": "/".join((self.namespace, role))},
-                    {"Key": "namespace", "Value": self.namespace},
-                    {"Key": "role", "Value": role},
-                    {"Key": "state", "Value": "pending"}
-                ]
-            )
-
-            journal.append((role, new_instances))
+        claimed = self.claim_warm_instances()
+        journal = self.provision_instances([
+            (role, instance, "pending",
+             instance.get("count", 1) - len(claimed.get(role, ())),
+             ("temp",))
+            for role, instance in self.dynamic_instance_conf.items()
+        ])
+        for role, instances in claimed.items():
+            if instances:
+                journal[role] = journal.get(role, []) + instances
 
-        time.sleep(5)
+        self.wait(
+            "pending instance tags",
+            lambda: self.tags_visible(
+                it.chain(*journal.values()), "state", "pending"),
+            timeout=120)
 
-        for role, instance_list in journal:
+        for role, instance_list in journal.items():
             for instance in instance_list: instance.wait_until_running()
-            self.instances[role]["pending"] = list(self.ec2.instances.filter(
-                InstanceIds=[
-                    instance.id for instance in instance_list
-                ]
-            ))
+            self.instances[role]["pending"] = self.inventory.get(
+                instance.id for instance in instance_list)
+
+        self.journal.record_instances("pending", dict(
+            (role, [instance.id for instance in instance_list])
+            for role, instance_list in journal.items()))
+
+        return plan
+
+    @traced
+    def finish_stage(self, plan):
+        # Second half of rolling_stage: provision the pending instances and
+        # make them the staged ones, or update the staged instances in place.
+        # Needs the static hosts to be provisioned (see rolling_base).
+        rev, env, fingerprint = (
+            plan["revision"], plan["env"], plan["fingerprint"])
+        if plan["in_place"]:
+            self.stage_in_place(rev)
+            return
 
-        self.run_play(
-            "prep-inventory",
-            "prep.yml",
-            {
+        if not self.journal.done("prep:pending"):
+            # after the fingerprint: the artifact changes with every revision
+            env["release_artifact"] = self.ensure_release(
+                rev, (("web", "pending"),))
+
+            playbooks, fragments = self.prep_playbooks({
                 "web": (("web", "pending"),),
                 "worker": (("worker", "pending"),),
                 "db": ("s/db+mq",),
                 "queue": ("s/db+mq",),
                 "dynamic": (("web", "pending"), ("worker", "pending"))
-            },
-            {
-                "revision": rev,
-                "admin_name": self.admin_name,
-                "admin_pass": self.admin_pass,
-                "public_name": self.public_name,
-                "deploy_mode": "staging",
-                "s3_bucket": self.s3_staging_bucket,
-                "aws_access_key_id": self.aws_access_key_id,
-                "aws_secret_access_key": self.aws_secret_access_key,
-                "ssl_cert": self.ssl_cert,
-                "ssl_chain": self.ssl_chain,
-                "ssl_dhparams": self.ssl_dhparams,
-                "ssl_key": self.ssl_key,
-            }
-        )
+            })
+            self.run_play("prep-inventory", playbooks, fragments, env)
+            self.journal.mark("prep:pending")
 
-
-        next(iter(
-            self.ec2.vpc_addresses.filter(PublicIps=[self.staging_ip])
-        )).associate(
-            InstanceId=self.instances["web"]["pending"][0].id
-        )
+        self.associate_address(
+            self.staging_ip, self.instances["web"]["pending"][0])
 
         journal = []
-        for role, entry in self.instances.items():
-            if not isinstance(entry, dict): continue
-            if entry["staged"]:
-                journal.extend(entry["staged"])
-
-            entry["staged"] = entry.pop("pending")
-            for instance in entry["staged"]:
-                instance.create_tags(Tags=[
-                    {"Key": "state", "Value": "staged"},
-                    {"Key": "revision", "Value": rev},
-                ])
-
-        for instance in journal: instance.terminate()
+        with self.tagging() as tags:
+            for role, entry in self.instances.items():
+                if not isinstance(entry, dict): continue
+                if entry["staged"]:
+                    journal.extend(entry["staged"])
+
+                entry["staged"] = entry.pop("pending")
+                tags.add(
+                    [instance.id for instance in entry["staged"]],
+                    [{"Key": "state", "Value": "staged"},
+                     {"Key": "revision", "Value": rev},
+                     {"Key": "stage-fingerprint", "Value": fingerprint}])
+
+        self.inventory.invalidate()
+        self.terminate_instances(journal)
         for instance in journal: instance.wait_until_terminated()
 
+    @traced
     def rolling_deploy(self):
         self.send_bot("deploying")
+        self.secrets.prefetch()
+
+        if self.journal.done("swap"):
+            self.send_bot("finishing the interrupted deploy")
+        else:
+            self.swap_fleets()
+
+        # refresh local instance cache (to reflect changes in elastic ip)
+        def addresses_settled():
+            self.refresh_instances()
+            web = self.instances["web"]
+            return (
+                web["live"][0].public_ip_address == self.production_ip and
+                web["staged"][0].public_ip_address == self.staging_ip
+            )
+
+        self.wait("elastic ip swap", addresses_settled, timeout=120)
 
         self.run_play(
             "reconfigure-inventory",
@@ -929,7 +2267,7 @@ class Deployment(object):
             {
                 "web": (("web", "staged"),),
                 "worker": (("worker", "staged"),),
-                "db": ("p/db",),
+                "db": ("s/db+mq",),
                 "queue": ("p/queue", "s/db+mq"),
                 "dynamic": (("web", "staged"), ("worker", "staged"))
             },
@@ -937,8 +2275,8 @@ class Deployment(object):
                 "admin_name": self.admin_name,
                 "admin_pass": self.admin_pass,
                 "public_name": self.public_name,
-                "deploy_mode": "production",
-                "s3_bucket": self.s3_production_bucket,
+                "deploy_mode": "staging",
+                "s3_bucket": self.s3_staging_bucket,
                 "aws_access_key_id": self.aws_access_key_id,
                 "aws_secret_access_key": self.aws_secret_access_key,
                 "ssl_cert": self.ssl_cert,
@@ -948,76 +2286,282 @@ class Deployment(object):
             }
         )
 
+    def swap_fleets(self):
+        # First half of rolling_deploy: reconfigure the staged instances for
+        # production and make them the live ones (and the live ones staged).
+        if not self.journal.done("reconfigure:production"):
+            self.run_play(
+                "reconfigure-inventory",
+                "reconfigure.yml",
+                {
+                    "web": (("web", "staged"),),
+                    "worker": (("worker", "staged"),),
+                    "db": ("p/db",),
+                    "queue": ("p/queue", "s/db+mq"),
+                    "dynamic": (("web", "staged"), ("worker", "staged"))
+                },
+                {
+                    "admin_name": self.admin_name,
+                    "admin_pass": self.admin_pass,
+                    "public_name": self.public_name,
+                    "deploy_mode": "production",
+                    "s3_bucket": self.s3_production_bucket,
+                    "aws_access_key_id": self.aws_access_key_id,
+                    "aws_secret_access_key": self.aws_secret_access_key,
+                    "ssl_cert": self.ssl_cert,
+                    "ssl_chain": self.ssl_chain,
+                    "ssl_dhparams": self.ssl_dhparams,
+                    "ssl_key": self.ssl_key,
+                }
+            )
+            self.journal.mark("reconfigure:production")
+
         # swap ips
-        next(iter(
-            self.ec2.vpc_addresses.filter(PublicIps=[self.production_ip])
-        )).associate(
-            InstanceId=self.instances["web"]["staged"][0].id
-        )
-        next(iter(
-            self.ec2.vpc_addresses.filter(PublicIps=[self.staging_ip])
-        )).associate(
-            InstanceId=self.instances["web"]["live"][0].id
-        )
+        self.associate_address(
+            self.production_ip, self.instances["web"]["staged"][0])
+        self.associate_address(
+            self.staging_ip, self.instances["web"]["live"][0])
 
         # rebrand staged -> live
         # rebrand live -> staged
-        for role, entry in self.instances.items():
-            if not isinstance(entry, dict): continue
-            staged_instances = entry["staged"]
-            live_instances = entry["live"]
-
-            for instance in staged_instances:
-                instance.create_tags(Tags=[
-                    {"Key": "state", "Value": "live"},
-                ])
+        with self.tagging() as tags:
+            for role, entry in self.instances.items():
+                if not isinstance(entry, dict): continue
+                staged_instances = entry["staged"]
+                live_instances = entry["live"]
 
-            for instance in live_instances:
-                instance.create_tags(Tags=[
-                    {"Key": "state", "Value": "staged"},
-                ])
+                tags.add(
+                    [instance.id for instance in staged_instances],
+                    [{"Key": "state", "Value": "live"},
+                     {"Key": "stage-fingerprint", "Value": ""}])
+                tags.add(
+                    [instance.id for instance in live_instances],
+                    [{"Key": "state", "Value": "staged"}])
 
-            entry["live"] = staged_instances
-            entry["staged"] = live_instances
+                entry["live"] = staged_instances
+                entry["staged"] = live_instances
 
-        # refresh local instance cache (to reflect changes in elastic ip)
-        time.sleep(30)
-        for role, entry in self.instances.items():
-            if not isinstance(entry, dict): continue
-            for state in ("live", "staged"):
-                entry[state] = list(
-                    self.ec2.instances.filter(InstanceIds=[
-                        instance.id for instance in entry[state]
-                    ])
-                )
-
-        self.run_play(
-            "reconfigure-inventory",
-            "reconfigure.yml",
-            {
-                "web": (("web", "staged"),),
-                "worker": (("worker", "staged"),),
-                "db": ("s/db+mq",),
-                "queue": ("p/queue", "s/db+mq"),
-                "dynamic": (("web", "staged"), ("worker", "staged"))
-            },
-            {
-                "admin_name": self.admin_name,
-                "admin_pass": self.admin_pass,
-                "public_name": self.public_name,
-                "deploy_mode": "staging",
-                "s3_bucket": self.s3_staging_bucket,
-                "aws_access_key_id": self.aws_access_key_id,
-                "aws_secret_access_key": self.aws_secret_access_key,
-                "ssl_cert": self.ssl_cert,
-                "ssl_chain": self.ssl_chain,
-                "ssl_dhparams": self.ssl_dhparams,
-                "ssl_key": self.ssl_key,
-            }
-        )
+        self.inventory.invalidate()
+        self.journal.mark("swap")
 
+    @traced
     def ensure_static_resources(self):
         self.ensure_static_key_pair()
         self.ensure_static_security_groups()
         self.ensure_static_instances()
 
+
+    def plan(self, operation, rev="master", force_base=False):
+        # Work out what stage (or deploy) would do from one snapshot of the
+        # inventory, without changing anything.  Returns the plan: the steps
+        # of step_graph that have something to do, each with its actions and
+        # estimated duration, and the estimate for the whole operation (its
+        # critical path).
+        self.inventory.invalidate()
+        rev, already_staged = self.check_rev(rev)
+        plan = {
+            "operation": operation,
+            "revision": rev,
+            "force_base": force_base,
+            "steps": [],
+            "estimate": 0.0,
+        }
+        if operation == "stage" and already_staged:
+            plan["reason"] = "revision {} already staged".format(rev)
+            return plan
+
+        # what an interrupted run of the same operation already did
+        journal = self.journal
+        if journal.load(*self.journal_key(operation, rev)):
+            plan["resume"] = True
+
+        actions = dict((name, []) for name, _ in self.step_graph[operation])
+        select = self.inventory.select
+
+        def ids(instances):
+            return sorted(instance.id for instance in instances)
+
+        base_roles = []
+        for role, conf in sorted(self.static_instance_conf.items()):
+            instances = select(role=role)
+            missing = max(conf.get("count", 1) - len(instances), 0)
+            if missing:
+                actions["base"].append({"action": "create", "role": role,
+                                        "state": "static", "count": missing})
+
+            fingerprint = self.base_fingerprint(role)
+            if force_base or missing or any(
+                    get_tag(instance.tags or [], "base-fingerprint") != (
+                        fingerprint)
+                    for instance in instances):
+                base_roles.append(role)
+
+        if base_roles:
+            actions["base"].append({
+                "action": "play", "inventory": "base-inventory",
+                "playbooks": ["base.yml", "cache.yml"], "roles": base_roles})
+
+        current = dict(
+            (role, dict(
+                (state, select(role=role, state=state))
+                for state in ("live", "staged", "pending")))
+            for role in self.dynamic_instance_conf.keys())
+
+        golden = self.golden_image() is not None
+        prep = ["prep.yml"] if golden else ["deps.yml", "prep.yml"]
+
+        # the first step that needs the release builds it
+        release_step = None
+
+        def prep_actions(state):
+            # after the launch of the instances in state
+            if not journal.done("prep:" + state):
+                actions["prep"].append({
+                    "action": "play", "inventory": "prep-inventory",
+                    "playbooks": prep, "state": state})
+            actions["prep"].append({
+                "action": "address", "role": "web", "state": state,
+                "ip": self.production_ip if state == "live"
+                      else self.staging_ip})
+
+        replaced = []
+        for state in ("live", "staged"):
+            if all(current[role][state] for role in current):
+                if not journal.done("ready:" + state) and (
+                        self.journaled_instances(state, dict(
+                            (role, entry[state])
+                            for role, entry in current.items()))):
+                    prep_actions(state)
+                continue
+
+            replaced.append(state)
+
+            for role, conf in sorted(self.dynamic_instance_conf.items()):
+                if current[role][state]:
+                    actions["launch"].append({
+                        "action": "terminate", "role": role, "state": state,
+                        "ids": ids(current[role][state])})
+                actions["launch"].append({
+                    "action": "create", "role": role, "state": state,
+                    "count": conf.get("count", 1)})
+
+            prep_actions(state)
+
+        if any(action["action"] == "play" for action in actions["prep"]):
+            release_step = "prep"
+
+        if operation == "stage":
+            env = self.stage_env(rev)
+            staged = dict(
+                (role, [] if "staged" in replaced else entry["staged"])
+                for role, entry in current.items())
+
+            if self.can_stage_in_place(self.stage_fingerprint(env), staged):
+                release_step = release_step or "stage"
+                actions["stage"].append({
+                    "action": "play", "inventory": "update-inventory",
+                    "playbooks": ["update.yml"], "state": "staged"})
+            elif self.journaled_instances("pending", dict(
+                    (role, entry["pending"])
+                    for role, entry in current.items())):
+                for role, entry in sorted(current.items()):
+                    actions["launch-pending"].append({
+                        "action": "reuse", "role": role, "state": "pending",
+                        "ids": ids(entry["pending"])})
+            else:
+                warm = self.warm_candidates()
+                for role, conf in sorted(self.dynamic_instance_conf.items()):
+                    if current[role]["pending"]:
+                        actions["launch-pending"].append({
+                            "action": "terminate", "role": role,
+                            "state": "pending",
+                            "ids": ids(current[role]["pending"])})
+                    if warm.get(role):
+                        actions["launch-pending"].append({
+                            "action": "claim", "role": role,
+                            "ids": ids(warm[role])})
+                    count = conf.get("count", 1) - len(warm.get(role, ()))
+                    if count > 0:
+                        actions["launch-pending"].append({
+                            "action": "create", "role": role,
+                            "state": "pending", "count": count})
+
+            if actions["launch-pending"]:
+                if not journal.done("prep:pending"):
+                    release_step = release_step or "stage"
+                    actions["stage"].append({
+                        "action": "play", "inventory": "prep-inventory",
+                        "playbooks": prep, "state": "pending"})
+                actions["stage"].append({
+                    "action": "address", "role": "web", "state": "pending",
+                    "ip": self.staging_ip})
+                actions["stage"].append({
+                    "action": "retag", "state": "pending", "to": "staged"})
+                actions["stage"].append({
+                    "action": "terminate", "state": "staged",
+                    "ids": [] if "staged" in replaced else ids(
+                        it.chain(*(entry["staged"]
+                                   for entry in current.values())))})
+
+        else:
+            if not journal.done("swap"):
+                if not journal.done("reconfigure:production"):
+                    actions["deploy"].append({
+                        "action": "play", "inventory": "reconfigure-inventory",
+                        "playbooks": ["reconfigure.yml"], "state": "staged"})
+                actions["deploy"].extend([
+                    {"action": "address", "role": "web", "state": "staged",
+                     "ip": self.production_ip},
+                    {"action": "address", "role": "web", "state": "live",
+                     "ip": self.staging_ip},
+                    {"action": "retag", "state": "staged", "to": "live"},
+                    {"action": "retag", "state": "live", "to": "staged"},
+                ])
+            actions["deploy"].append({
+                "action": "play", "inventory": "reconfigure-inventory",
+                "playbooks": ["reconfigure.yml"], "state": "live"})
+
+        if release_step and not os.path.exists(os.path.join(
+                "scratch", "releases", rev + ".tar.gz")):
+            actions[release_step].insert(
+                0, {"action": "release", "revision": rev})
+
+        # Each step's estimate: its launches overlap, everything else adds
+        # up.  Steps with nothing to do are left out; the steps after them
+        # wait for theirs instead.
+        finish = {}
+        planned_after = {}
+        for name, after in self.step_graph[operation]:
+            start = max([finish[dependency] for dependency in after] or [0.0])
+            planned_after[name] = []
+            for dependency in after:
+                for step in ([dependency] if actions[dependency]
+                             else planned_after[dependency]):
+                    if step not in planned_after[name]:
+                        planned_after[name].append(step)
+
+            if not actions[name]:
+                finish[name] = start
+                continue
+
+            launches = [0.0]
+            estimate = 0.0
+            for action in actions[name]:
+                if action["action"] == "create":
+                    launches.append(self.estimate("launch:" + action["role"]))
+                elif action["action"] == "play":
+                    estimate += self.estimate("play:" + action["inventory"])
+                elif action["action"] == "release":
+                    estimate += self.estimate("play:release-inventory")
+            estimate += max(launches)
+
+            finish[name] = start + estimate
+            plan["steps"].append({
+                "name": name,
+                "after": planned_after[name],
+                "actions": actions[name],
+                "estimate": estimate,
+            })
+
+        plan["estimate"] = max(finish.values())
+        return plan
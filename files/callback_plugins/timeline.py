@@ -0,0 +1,75 @@
+
+# Records per-task, per-host start and end times for a playbook run and writes
+# them as JSON to the path given by the SUMOBOT_TIMELINE environment variable.
+# Enabled through callback_whitelist in ansible.cfg; see Deployment.run_play.
+
+import json
+import os
+import time
+
+from ansible.plugins.callback import CallbackBase
+
+class CallbackModule(CallbackBase):
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = "aggregate"
+    CALLBACK_NAME = "timeline"
+    CALLBACK_NEEDS_WHITELIST = True
+
+    def __init__(self, *args, **kwargs):
+        super(CallbackModule, self).__init__(*args, **kwargs)
+        self.path = os.environ.get("SUMOBOT_TIMELINE")
+        self.playbook = None
+        self.play = None
+        self.task_start = None
+        self.host_start = {}
+        self.entries = []
+
+    def v2_playbook_on_start(self, playbook):
+        self.playbook = os.path.basename(playbook._file_name)
+
+    def v2_playbook_on_play_start(self, play):
+        self.play = play.get_name().strip()
+
+    def v2_playbook_on_task_start(self, task, is_conditional):
+        self.task_start = time.time()
+        self.host_start = {}
+
+    def v2_playbook_on_handler_task_start(self, task):
+        self.v2_playbook_on_task_start(task, False)
+
+    def v2_runner_on_start(self, host, task):
+        self.host_start[host.get_name()] = time.time()
+
+    def record(self, result, status):
+        end = time.time()
+        host = result._host.get_name()
+        start = self.host_start.get(host, self.task_start or end)
+        self.entries.append({
+            "playbook": self.playbook,
+            "play": self.play,
+            "task": result._task.get_name(),
+            "host": host,
+            "status": status,
+            "start": start,
+            "end": end,
+            "duration": end - start,
+        })
+
+    def v2_runner_on_ok(self, result):
+        self.record(result, "ok")
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        self.record(result, "ignored" if ignore_errors else "failed")
+
+    def v2_runner_on_skipped(self, result):
+        self.record(result, "skipped")
+
+    def v2_runner_on_unreachable(self, result):
+        self.record(result, "unreachable")
+
+    def v2_playbook_on_stats(self, stats):
+        if not self.path:
+            return
+
+        with open(self.path, "w") as f:
+            json.dump({"entries": self.entries}, f, indent=2)
@@ -4,7 +4,7 @@ import json
 import os.path
 
 from argparse import ArgumentParser
-from time import sleep
+from time import sleep, time
 
 from girder.constants import AssetstoreType
 from girder_client import GirderClient
@@ -59,6 +59,31 @@ def ensure_user(client, **kwds):
                                             firstName=kwds['firstName'],
                                             lastName=kwds['lastName']))
 
+def girder_up():
+    try:
+        client.get('system/version')
+    except Exception:
+        return False
+    return True
+
+def wait_for_girder(up=True, timeout=300, delay=0.5, max_delay=10):
+    start = time()
+    while girder_up() != up:
+        if time() - start > timeout:
+            return False
+        sleep(delay)
+        delay = min(2*delay, max_delay)
+    return True
+
+def wait_for_restart():
+    # the restart is asynchronous: give the old server a moment to go away,
+    # then wait for the new one to answer
+    wait_for_girder(up=False, timeout=15)
+    start = time()
+    if not wait_for_girder(up=True):
+        raise RuntimeError('girder did not come back up after restart')
+    print('waited {:.1f}s for girder to restart'.format(time() - start))
+
 def find_assetstore(name):
     offset = 0
     limit = 50
@@ -93,6 +118,9 @@ args = parser.parse_args()
 
 client = GirderClient(host=args.host, port=args.port)
 
+if not wait_for_girder(up=True, timeout=600):
+    raise RuntimeError('girder did not come up')
+
 user, password = args.admin.split(":", 1)
 
 if find_user('girder'):
@@ -123,7 +151,7 @@ client.put(
 )
 client.put('system/restart')
 
-sleep(30)
+wait_for_restart()
 
 client.put('system/setting',
            parameters=dict(list=json.dumps([
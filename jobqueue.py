@@ -0,0 +1,429 @@
+
+import collections
+import fcntl
+import json
+import os
+import os.path
+import socket
+import subprocess as sp
+import sys
+import time
+
+from contextlib import contextmanager
+
+# How long a runner's claim on a job stays valid without being renewed.  The
+# runner renews it every LEASE_TTL/3 seconds while the job is alive, so an
+# expired lease means the runner died.
+LEASE_TTL = 60.0
+
+# Jobs that are safe to start over from the beginning after their runner died
+# part way through.  A deploy interrupted in the middle of the swap is not:
+# it is failed instead, and left for a human to look at (deploying again
+# finishes it; see Deployment.journal).
+RETRYABLE = frozenset(("bake", "stage", "update"))
+MAX_ATTEMPTS = 2
+
+# Finished jobs are kept around (newest first) so that chat can still report
+# on them.
+KEEP_FINISHED = 20
+
+PENDING_STATES = frozenset(("queued", "running"))
+
+# Lines of a failed job's output (other than bot messages) passed on to
+# whoever requested it.
+ERROR_TAIL = 20
+
+def _pid_alive(pid):
+    if pid is None:
+        return False
+
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+
+    return True
+
+def _lease_alive(lease, now):
+    if lease["host"] != socket.gethostname():
+        # can't look at the processes; trust the lease
+        return lease["expires"] > now
+
+    # a job process that outlived its runner still owns the job: starting it
+    # over would run two copies at once
+    if _pid_alive(lease.get("child")):
+        return True
+
+    return lease["expires"] > now and _pid_alive(lease["pid"])
+
+class JobQueue(object):
+    # Persistent queue of deployment operations, shared by every process
+    # running out of the same working directory.
+    #
+    # All state lives in a single json file that is only read or written
+    # while holding an exclusive flock on a lock file next to it, and that is
+    # replaced with write-then-rename (only when it changed) so that a crash
+    # never leaves it half-written.  A separate flock, held for its whole
+    # lifetime, marks the (single) runner process.
+
+    def __init__(self, path=os.path.join("scratch", "queue")):
+        self.path = path
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        self.state_path = os.path.join(path, "jobs.json")
+        self.lock_path = os.path.join(path, "lock")
+        self.runner_lock_path = os.path.join(path, "runner.lock")
+        self._runner_lock = None
+
+    def log_path(self, job_id):
+        return os.path.join(self.path, "{}.log".format(job_id))
+
+    @contextmanager
+    def locked(self):
+        with open(self.lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                state = {"next_id": 1, "jobs": []}
+                if os.path.exists(self.state_path):
+                    with open(self.state_path) as f:
+                        state = json.load(f)
+                original = json.dumps(state, sort_keys=True)
+
+                yield state
+
+                # readers (e.g.: follow(), once a second) leave it alone
+                if json.dumps(state, sort_keys=True) == original:
+                    return
+
+                tmp_path = self.state_path + ".tmp"
+                with open(tmp_path, "w") as f:
+                    json.dump(state, f, indent=2, sort_keys=True)
+                os.rename(tmp_path, self.state_path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _reap(self, state, now):
+        # Take back jobs whose runner has gone away.
+        for job in state["jobs"]:
+            if job["state"] != "running": continue
+
+            lease = job["lease"]
+            if _lease_alive(lease, now):
+                continue
+
+            job["lease"] = None
+            if (job["operation"] in RETRYABLE and
+                    job["attempts"] < MAX_ATTEMPTS):
+                job["state"] = "queued"
+            else:
+                self._finish(job, "failed", None, now,
+                             "runner {}:{} went away".format(
+                                 lease["host"], lease["pid"]))
+
+    def _finish(self, job, job_state, returncode, now, reason=None):
+        job["state"] = job_state
+        job["returncode"] = returncode
+        job["finished"] = now
+        job["lease"] = None
+        if reason is not None:
+            job["reason"] = reason
+
+    def _trim(self, state):
+        pending = [job for job in state["jobs"]
+                   if job["state"] in PENDING_STATES]
+        finished = sorted(
+            (job for job in state["jobs"]
+             if job["state"] not in PENDING_STATES),
+            key=lambda job: job["finished"], reverse=True)
+        state["jobs"] = pending + finished[:KEEP_FINISHED]
+
+    def submit(self, operation, revision=None, sha=None, options=None):
+        # Add a job, or fold the request into an equivalent one already in
+        # the queue.  Returns (job, disposition), where disposition is one of
+        # "queued", "coalesced" or "running".
+        #
+        # Stage requests for a sha that is already queued or being staged
+        # coalesce with that job; a stage request for any other sha
+        # supersedes every stage still waiting in the queue.  A deploy
+        # coalesces with a deploy waiting at the end of the queue (deploying
+        # twice in a row would swap the fleets straight back).  Options (such
+        # as force_base) are merged into a queued job they coalesce with; a
+        # running job only absorbs requests whose options it already has.
+        options = dict(options or {})
+        now = time.time()
+        with self.locked() as state:
+            self._reap(state, now)
+
+            queued = [job for job in state["jobs"] if job["state"] == "queued"]
+            running = [job for job in state["jobs"]
+                       if job["state"] == "running"]
+
+            if operation == "stage":
+                for job in running + queued:
+                    if job["operation"] != "stage" or job["sha"] != sha:
+                        continue
+
+                    job_options = job.setdefault("options", {})
+                    if job in running:
+                        if any(job_options.get(key) != value
+                               for key, value in options.items()):
+                            continue
+                        job["requests"] += 1
+                        return job, "running"
+
+                    job_options.update(options)
+                    job["requests"] += 1
+                    return job, "coalesced"
+
+            elif operation == "deploy":
+                if queued and queued[-1]["operation"] == "deploy":
+                    queued[-1].setdefault("options", {}).update(options)
+                    queued[-1]["requests"] += 1
+                    return queued[-1], "coalesced"
+
+            job = {
+                "id": state["next_id"],
+                "operation": operation,
+                "revision": revision,
+                "sha": sha,
+                "options": options,
+                "state": "queued",
+                "submitted": now,
+                "started": None,
+                "finished": None,
+                "returncode": None,
+                "attempts": 0,
+                "requests": 1,
+                "lease": None,
+            }
+            state["next_id"] += 1
+
+            if operation == "stage":
+                for old in queued:
+                    if old["operation"] != "stage": continue
+                    self._finish(old, "superseded", None, now,
+                                 "superseded by job {}".format(job["id"]))
+                    old["superseded_by"] = job["id"]
+
+            state["jobs"].append(job)
+            self._trim(state)
+
+            return job, "queued"
+
+    def claim(self):
+        # Lease the oldest queued job to this process, if there is one.
+        now = time.time()
+        with self.locked() as state:
+            self._reap(state, now)
+            for job in state["jobs"]:
+                if job["state"] != "queued": continue
+
+                job["state"] = "running"
+                job["attempts"] += 1
+                job["started"] = now
+                job["lease"] = {
+                    "host": socket.gethostname(),
+                    "pid": os.getpid(),
+                    "child": None,
+                    "expires": now + LEASE_TTL,
+                }
+                return job
+
+    def renew(self, job_id, child=None):
+        with self.locked() as state:
+            for job in state["jobs"]:
+                if job["id"] == job_id and job["lease"]:
+                    job["lease"]["expires"] = time.time() + LEASE_TTL
+                    if child is not None:
+                        job["lease"]["child"] = child
+
+    def finish(self, job_id, returncode):
+        with self.locked() as state:
+            for job in state["jobs"]:
+                if job["id"] != job_id: continue
+                self._finish(job, "done" if returncode == 0 else "failed",
+                             returncode, time.time())
+            self._trim(state)
+
+    def get(self, job_id):
+        with self.locked() as state:
+            for job in state["jobs"]:
+                if job["id"] == job_id:
+                    return job
+
+    def report(self):
+        # Snapshot of the queue for status reporting: every job, in the
+        # order it will run (or ran), with queued jobs numbered by position.
+        with self.locked() as state:
+            self._reap(state, time.time())
+            jobs = list(state["jobs"])
+
+        position = 0
+        for job in jobs:
+            if job["state"] == "queued":
+                position += 1
+                job["position"] = position
+
+        return {"runner": self.runner_active(), "jobs": jobs}
+
+    def position(self, job_id):
+        for job in self.report()["jobs"]:
+            if job["id"] == job_id:
+                return job.get("position")
+
+    def runner_active(self):
+        if self._runner_lock is not None:
+            return True
+
+        with open(self.runner_lock_path, "a") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                return True
+
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            return False
+
+    def ensure_runner(self, argv):
+        # Start a detached runner with the given command line unless one is
+        # already running.  Checked under the queue lock, so that it can not
+        # race with a runner deciding to exit on an empty queue.
+        with self.locked():
+            if self.runner_active():
+                return False
+
+            with open(os.path.join(self.path, "runner.log"), "ab") as log:
+                sp.Popen(argv, stdin=open(os.devnull), stdout=log,
+                         stderr=sp.STDOUT, close_fds=True,
+                         preexec_fn=os.setsid)
+
+            return True
+
+    def run(self, job_argv, idle_exit=True, poll=2.0):
+        # Run queued jobs one at a time, each in its own process with its
+        # output going to the job's log file, until the queue is empty (or
+        # forever, if idle_exit is false).  Returns False right away if
+        # another runner already holds the queue.
+        self._runner_lock = open(self.runner_lock_path, "a")
+        try:
+            fcntl.flock(self._runner_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            self._runner_lock.close()
+            self._runner_lock = None
+            return False
+
+        try:
+            while True:
+                job = self.claim()
+                if job is None:
+                    if not idle_exit:
+                        time.sleep(poll)
+                        continue
+
+                    with self.locked() as state:
+                        if not any(entry["state"] == "queued"
+                                   for entry in state["jobs"]):
+                            self._release_runner()
+                            return True
+                    continue
+
+                self.run_job(job, job_argv(job))
+        finally:
+            self._release_runner()
+
+    def _release_runner(self):
+        if self._runner_lock is not None:
+            fcntl.flock(self._runner_lock, fcntl.LOCK_UN)
+            self._runner_lock.close()
+            self._runner_lock = None
+
+    def run_job(self, job, argv):
+        with open(self.log_path(job["id"]), "ab") as log:
+            proc = sp.Popen(argv, stdin=open(os.devnull), stdout=log,
+                            stderr=sp.STDOUT,
+                            env=dict(os.environ, PYTHONUNBUFFERED="1"))
+            self.renew(job["id"], child=proc.pid)
+
+            renewed = time.time()
+            while proc.poll() is None:
+                time.sleep(1)
+                if time.time() - renewed > LEASE_TTL/3:
+                    self.renew(job["id"])
+                    renewed = time.time()
+
+        self.finish(job["id"], proc.returncode)
+        return proc.returncode
+
+    def request(self, operation, revision, sha, runner_argv, notify,
+                out=sys.stdout, options=None, err=sys.stderr):
+        # Submit the operation, start a runner (with runner_argv, unless
+        # None) if none is active, and follow the job to the end, reporting
+        # on it through notify().  If the job fails, the tail of its output
+        # goes to err.  Returns the job's exit status.
+        job, disposition = self.submit(operation, revision, sha, options)
+        if runner_argv is not None:
+            self.ensure_runner(runner_argv)
+
+        if disposition == "coalesced":
+            notify("same as queued job {}; waiting for it".format(job["id"]))
+        elif disposition == "running":
+            notify("same as running job {}; waiting for it".format(job["id"]))
+        else:
+            position = self.position(job["id"])
+            if position and position > 1:
+                notify("queued as job {} at position {}".format(
+                    job["id"], position))
+
+        job = self.follow(job["id"], out)
+        if job is None:
+            return 1
+
+        if job["state"] == "superseded":
+            notify("job {} {}".format(job["id"], job["reason"]))
+            return 0
+
+        if job["state"] != "done":
+            for line in self.log_tail(job["id"]):
+                err.write(line + "\n")
+            err.flush()
+
+            notify("job {} {}".format(
+                job["id"], job.get("reason") or "failed"))
+            return job["returncode"] or 1
+
+        return 0
+
+    def log_tail(self, job_id, count=ERROR_TAIL):
+        # the last count lines of the job's output, bot messages left out
+        try:
+            with open(self.log_path(job_id)) as log:
+                return list(collections.deque(
+                    (line.rstrip("\n") for line in log
+                     if not line.startswith("BOT: ")),
+                    maxlen=count))
+        except (IOError, OSError):
+            return []
+
+    def follow(self, job_id, out=sys.stdout, poll=1.0):
+        # Copy the job's log to out as it grows, until the job has finished.
+        # Returns the finished job.
+        offset = 0
+        while True:
+            job = self.get(job_id)
+            finished = job is None or job["state"] not in PENDING_STATES
+
+            log_path = self.log_path(job_id)
+            if os.path.exists(log_path):
+                with open(log_path) as log:
+                    log.seek(offset)
+                    chunk = log.read()
+                    offset = log.tell()
+                if chunk:
+                    out.write(chunk)
+                    out.flush()
+
+            if finished:
+                return job
+
+            time.sleep(poll)
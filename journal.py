@@ -0,0 +1,103 @@
+import json
+import os
+import os.path
+import threading
+import time
+
+JOURNAL_PATH = os.path.join("scratch", "journal.json")
+
+class Journal(object):
+    # Durable record of how far a stage or deploy of a revision got: the
+    # instances it launched (by state and role) and the steps it finished.
+    # A run that fails leaves its journal behind; the next run of the same
+    # operation and revision picks it up (see begin()) and skips what is
+    # already done.  A successful run removes it.
+    #
+    # Every change is written out straight away, with write-then-rename so
+    # that a crash never leaves the file half-written.  Safe to share between
+    # the threads of a Deployment.
+
+    def __init__(self, path=JOURNAL_PATH):
+        self.path = path
+        self.state = None
+        self._lock = threading.Lock()
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _write(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.state, f, indent=2, sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+    def load(self, operation, revision):
+        # Pick up the journal left by an earlier run of operation at
+        # revision, if there is one, without starting a run (done() and
+        # instances() then answer from it).  Returns whether there is one.
+        with self._lock:
+            state = self._read()
+            if state is not None and (
+                    state["operation"], state["revision"]) != (
+                        operation, revision):
+                state = None
+
+            self.state = state
+            return state is not None
+
+    def begin(self, operation, revision):
+        # Start journaling a run, carrying on from the journal of an earlier
+        # run of the same operation and revision if there is one.  Returns
+        # whether it does.
+        if self.load(operation, revision):
+            return True
+
+        with self._lock:
+            self.state = {
+                "operation": operation,
+                "revision": revision,
+                "started": time.time(),
+                "instances": {},
+                "done": [],
+            }
+            self._write()
+            return False
+
+    def finish(self):
+        with self._lock:
+            self.state = None
+            try: os.remove(self.path)
+            except OSError: pass
+
+    def done(self, step):
+        with self._lock:
+            return self.state is not None and step in self.state["done"]
+
+    def mark(self, step):
+        with self._lock:
+            if self.state is None or step in self.state["done"]: return
+            self.state["done"].append(step)
+            self._write()
+
+    def instances(self, state):
+        # role -> ids of the instances launched for state, or {}
+        with self._lock:
+            if self.state is None: return {}
+            return dict(self.state["instances"].get(state, {}))
+
+    def record_instances(self, state, instances):
+        # instances: role -> ids.  The steps done for the instances recorded
+        # before (prep:<state>, ready:<state>) are forgotten: they were not
+        # done for these.
+        with self._lock:
+            if self.state is None: return
+            self.state["instances"][state] = dict(
+                (role, sorted(ids)) for role, ids in instances.items())
+            self.state["done"] = [
+                step for step in self.state["done"]
+                if step not in ("prep:" + state, "ready:" + state)]
+            self._write()
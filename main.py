@@ -1,64 +1,319 @@
 
+import json
 import os
 import os.path
-import shutil
 import sys
+import time
 
 from argparse import ArgumentParser
 
 from deployment import Deployment
+from jobqueue import JobQueue
+from scheduler import Scheduler
+
+# operations that change the deployment; these run one at a time, through the
+# job queue
+QUEUED_OPERATIONS = ("apply", "bake", "deploy", "stage", "update")
+
+PLAN_PATH = os.path.join("scratch", "plan.json")
+
+def run_steps(D, scheduler):
+    # Run the steps of an operation, and report the critical path through
+    # them even if one failed.
+    try:
+        scheduler.run()
+    finally:
+        scheduler.report(D.send_bot)
+
+def apply_plan(D, plan):
+    # Carry out a plan made by D.plan(): run the steps it lists, each as soon
+    # as the steps it comes after are done.
+    rev = plan["revision"]
+    S = Scheduler(D.tracer)
+    steps = {
+        "base": lambda: D.rolling_base(force=plan["force_base"]),
+        "launch": lambda: D.launch_dynamic_instances(rev),
+        "prep": lambda: D.prep_dynamic_instances(
+            rev, S.results["launch"] if "launch" in S.results
+                 else D.launch_dynamic_instances(rev)),
+        "launch-pending": lambda: D.launch_stage(rev),
+        "stage": lambda: D.finish_stage(
+            S.results.get("launch-pending") or D.launch_stage(rev)),
+        "deploy": D.rolling_deploy,
+    }
+
+    for step in plan["steps"]:
+        S.add(step["name"], steps[step["name"]], after=step["after"])
+
+    # a failed run leaves its journal behind for the next run of the plan to
+    # carry on from (see D.plan)
+    if D.journal.begin(*D.journal_key(plan["operation"], rev)):
+        D.send_bot("resuming the interrupted {}".format(plan["operation"]))
 
-def deploy(args):
-    D = Deployment()
     D.ensure_static_resources()
+    D.load_dynamic_instances()
 
-    with D.security():
-        D.rolling_base()
-        D.ensure_dynamic_instances(args.revision)
-
-    # The idea behind the D.security() context manager is to have an easy way to
-    # expose port 22 on AWS instances, run ansible playbooks on them, and then
-    # promptly close off port 22 access.
-    #
-    # However, D.security() will only consider instances that were around at the
-    # time the context was created.  So, if ensure_dynamic_instances ends up
-    # deciding that it needs to (re)create some instances, then the new instanes
-    # will not have their ports exposed.
-    #
-    # The straightforward solution, which is what is implemented here, is to
-    # just exit the security context and enter a new one, at which point we'd be
-    # sure to have all the ports we need exposed.
-    with D.security():
-        D.rolling_deploy()
+    # D.security() exposes port 22 on the namespace's instances for as long as
+    # the context is open, so that ansible can reach them.  Instances created
+    # by D while the context is open are launched with the same exposure, and
+    # are closed off along with the rest.  Closing happens in the background;
+    # join_background() waits for it before the process exits.
+    with D.security(wait=False):
+        run_steps(D, S)
+
+    D.journal.finish()
+
+def describe_action(action):
+    what = action["action"]
+    if what == "create":
+        return "launch {count} {role} ({state})".format(**action)
+    if what == "terminate":
+        return "terminate {} ({}){}".format(
+            action.get("role", "all"), action["state"],
+            "".join(" " + instance_id for instance_id in action["ids"]))
+    if what == "reuse":
+        return "carry on with {} ({}) {}".format(
+            action["role"], action["state"], " ".join(action["ids"]))
+    if what == "claim":
+        return "claim warm {} {}".format(
+            action["role"], " ".join(action["ids"]))
+    if what == "play":
+        return "run {} on {}".format(
+            ", ".join(action["playbooks"]),
+            ", ".join(action["roles"]) if "roles" in action
+            else action["state"])
+    if what == "release":
+        return "build release {}".format(action["revision"][:10])
+    if what == "address":
+        return "move {ip} to {role} ({state})".format(**action)
+    if what == "retag":
+        return "retag {state} as {to}".format(**action)
+    return what
+
+def report_plan(D, plan):
+    if not plan["steps"]:
+        D.send_bot(plan.get("reason", "nothing to do"))
+        return
+
+    D.send_bot("{} {}{}: estimated {:.0f}s".format(
+        plan["operation"],
+        plan["revision"][:10],
+        " (resuming an interrupted run)" if plan.get("resume") else "",
+        plan["estimate"]))
+    for step in plan["steps"]:
+        D.send_bot("  {} (~{:.0f}s{})".format(
+            step["name"],
+            step["estimate"],
+            ", after " + ", ".join(step["after"]) if step["after"] else ""))
+        for action in step["actions"]:
+            D.send_bot("    " + describe_action(action))
 
+def deploy(args):
+    D = Deployment()
+    plan = D.plan("deploy", args.revision, args.force_base)
+    D.send_bot("deploying: estimated {:.0f}s".format(plan["estimate"]))
+    apply_plan(D, plan)
+
+    D.join_background()
     D.send_bot("deploy complete")
+    D.report_timeline()
 
 def stage(args):
     D = Deployment()
-    rev, staged = D.check_rev(args.revision)
-    if staged:
-        D.send_bot("revision {} already staged".format(rev))
-    else:
-        D.ensure_static_resources()
-        with D.security():
-            D.rolling_base()
-            D.ensure_dynamic_instances(args.revision)
+    plan = D.plan("stage", args.revision, args.force_base)
+    if not plan["steps"]:
+        D.send_bot(plan.get("reason", "nothing to do"))
+        return
+
+    D.send_bot("staging {}: estimated {:.0f}s".format(
+        plan["revision"][:10], plan["estimate"]))
+    apply_plan(D, plan)
+    D.join_background()
+    D.send_bot("revision {} successfully staged".format(plan["revision"]))
+
+    # refill what rolling_stage took from the warm pool, in the background
+    D.replenish_warm_pool(wait=False)
+    D.report_timeline()
+    D.join_background()
+
+def plan(args):
+    # Show (and save, for apply) what stage, or deploy with --target deploy,
+    # would do.
+    D = Deployment()
+    result = D.plan(args.target, args.revision, args.force_base)
+
+    path = args.plan or PLAN_PATH
+    with open(path + ".tmp", "w") as f:
+        json.dump(result, f, indent=2, sort_keys=True)
+    os.rename(path + ".tmp", path)
+
+    if args.json:
+        json.dump(result, sys.stdout, sort_keys=True)
+        sys.stdout.write("\n")
+        return
+
+    report_plan(D, result)
+
+def apply(args):
+    # Carry out a saved plan, provided the deployment has not changed since
+    # it was made.
+    D = Deployment()
+    with open(args.plan or PLAN_PATH) as f:
+        saved = json.load(f)
+
+    current = json.loads(json.dumps(
+        D.plan(saved["operation"], saved["revision"], saved["force_base"])))
+    if ([(step["name"], step["actions"]) for step in current["steps"]] !=
+            [(step["name"], step["actions"]) for step in saved["steps"]]):
+        D.send_bot("the deployment has changed since the plan was made; "
+                   "plan again")
+        return 1
+
+    if not saved["steps"]:
+        D.send_bot(saved.get("reason", "nothing to do"))
+        return
+
+    apply_plan(D, saved)
+    D.join_background()
+    D.send_bot("plan applied")
+
+    if saved["operation"] == "stage":
+        D.replenish_warm_pool(wait=False)
+    D.report_timeline()
+    D.join_background()
+
+def bake(args):
+    D = Deployment()
+    D.ensure_static_key_pair()
+    D.ensure_static_security_groups()
 
-        # See above comment explaining why we use two separate block contexts
-        with D.security():
-            D.rolling_stage(args.revision)
+    with D.security():
+        D.bake_image()
 
-        D.send_bot("revision {} successfully staged".format(rev))
+    # pool instances prepared from an older image are replaced
+    D.replenish_warm_pool()
 
 def status(args):
-    pass
+    D = Deployment()
+    report = D.status()
+
+    if args.json:
+        json.dump(report, sys.stdout, sort_keys=True)
+        sys.stdout.write("\n")
+        return
+
+    for name, address in sorted(report["addresses"].items()):
+        D.send_bot("{}: {} -> {}".format(
+            name, address["ip"], address["instance_id"] or "unassociated"))
+
+    for role, states in sorted(report["roles"].items()):
+        if not states:
+            D.send_bot("{}: no instances".format(role))
+
+        for state, instances in sorted(states.items()):
+            for instance in instances:
+                D.send_bot("{} ({}): {} {} rev={} ports=[{}]{}".format(
+                    role,
+                    state,
+                    instance["id"],
+                    instance["public_ip"] or "-",
+                    (instance["revision"] or "-")[:10],
+                    " ".join(
+                        "{}{}".format(port, "+" if up else "-")
+                        for port, up in sorted(
+                            instance["ports"].items(),
+                            key=lambda kv: int(kv[0]))
+                    ),
+                    "".join(" [{}]".format(name)
+                            for name in instance["elastic_ip"]),
+                ))
 
 def update(args):
     pass
 
+def queue(args):
+    report = JobQueue().report()
+
+    if args.json:
+        json.dump(report, sys.stdout, sort_keys=True)
+        sys.stdout.write("\n")
+        return
+
+    D = Deployment()
+    pending = [job for job in report["jobs"]
+               if job["state"] in ("queued", "running")]
+    if not pending:
+        D.send_bot("queue is empty")
+
+    for job in pending:
+        D.send_bot("job {} {}{}: {}".format(
+            job["id"],
+            job["operation"],
+            " " + job["revision"] if job["revision"] else "",
+            "running for {:.0f}s".format(time.time() - job["started"])
+            if job["state"] == "running"
+            else "queued at position {}".format(job["position"]),
+        ))
+
+    if pending and not report["runner"]:
+        D.send_bot("warning: no queue runner is active")
+
+def job_argv(job):
+    # command line the queue runner uses to run a job
+    argv = [sys.executable, os.path.abspath(__file__), "--direct",
+            job["operation"]]
+    if job["sha"] or job["revision"]:
+        argv.extend(("--revision", job["sha"] or job["revision"]))
+    options = job.get("options", {})
+    if options.get("force_base"):
+        argv.append("--force-base")
+    if options.get("plan"):
+        argv.extend(("--plan", options["plan"]))
+    return argv
+
+RUNNER_ARGV = [sys.executable, os.path.abspath(__file__), "runner"]
+
+def runner(args):
+    if not JobQueue().run(job_argv, idle_exit=not args.forever):
+        sys.stderr.write("another queue runner is already active\n")
+        sys.exit(1)
+
+def daemon(args):
+    from daemon import Daemon
+    Daemon(job_argv).serve_forever()
+
+def submit(args):
+    # Queue the operation, start a runner if none is active, and follow the
+    # job's output until it finishes.
+    D = Deployment()
+
+    revision = sha = None
+    if args.operation == "stage":
+        revision = args.revision
+        sha = D.resolve_rev(revision)
+
+    options = {}
+    if args.force_base:
+        options["force_base"] = True
+    if args.operation == "apply":
+        options["plan"] = os.path.abspath(args.plan or PLAN_PATH)
+
+    return JobQueue().request(
+        args.operation, revision, sha, RUNNER_ARGV, D.send_bot,
+        options=options)
+
 def main(args):
-    {
+    if args.operation in QUEUED_OPERATIONS and not args.direct:
+        return submit(args)
+
+    return {
+        "apply": apply,
+        "bake": bake,
+        "daemon": daemon,
         "deploy": deploy,
+        "plan": plan,
+        "queue": queue,
+        "runner": runner,
         "stage": stage,
         "status": status,
         "update": update,
@@ -67,29 +322,40 @@ def main(args):
 if __name__ == "__main__":
     parser = ArgumentParser()
     parser.add_argument(
-        "operation", choices=("deploy", "stage", "status", "update"),
+        "operation",
+        choices=("apply", "bake", "daemon", "deploy", "plan", "queue",
+                 "runner", "stage", "status", "update"),
         help="operation to perform"
     )
     parser.add_argument(
         "-v", "--revision", help="git revision to stage", default="master"
     )
+    parser.add_argument(
+        "--json", action="store_true",
+        help="print status, queue or plan as json"
+    )
+    parser.add_argument(
+        "--direct", action="store_true",
+        help="run the operation in this process instead of through the job "
+             "queue (used by the queue runner)"
+    )
+    parser.add_argument(
+        "--forever", action="store_true",
+        help="keep the queue runner going when the queue is empty"
+    )
+    parser.add_argument(
+        "--target", choices=("stage", "deploy"), default="stage",
+        help="operation to plan"
+    )
+    parser.add_argument(
+        "--plan",
+        help="plan file written by plan and read by apply (default: {})"
+             .format(PLAN_PATH)
+    )
+    parser.add_argument(
+        "--force-base", action="store_true",
+        help="run base.yml on every static host, even those already "
+             "provisioned with the current playbooks"
+    )
 
-    args = parser.parse_args()
-
-    need_file_lock = args.operation in ("deploy", "stage", "update")
-
-    if need_file_lock:
-        dir_path = os.path.join(os.getcwd(), "lock")
-        try:
-            os.mkdir(dir_path)
-        except OSError:
-            sys.stderr.write("locking operation currently taking place\n")
-            sys.exit(1)
-
-        try:
-            main(args)
-        finally:
-            shutil.rmtree(dir_path)
-    else:
-        main(args)
-
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,134 @@
+import sys
+import threading
+import time
+import traceback
+
+class StepFailed(Exception):
+    pass
+
+class Scheduler(object):
+    # Runs a graph of steps, each on its own thread as soon as the steps it
+    # comes after have finished.  A failed step fails the steps after it;
+    # the others still run to completion before run() raises.
+
+    def __init__(self, tracer=None):
+        self.tracer = tracer
+        self.steps = []
+        self.after = {}
+        self.funcs = {}
+        self.results = {}
+        self.timings = {}
+        self.errors = {}
+        self._cond = threading.Condition()
+
+    def add(self, name, func, after=()):
+        for dependency in after:
+            if dependency not in self.funcs:
+                raise ValueError("step {} comes after unknown step {}".format(
+                    name, dependency))
+
+        self.steps.append(name)
+        self.after[name] = tuple(after)
+        self.funcs[name] = func
+
+    def _run_step(self, name, parent):
+        start = time.time()
+        try:
+            if self.tracer is None:
+                result = self.funcs[name]()
+            else:
+                with self.tracer.under(parent), \
+                        self.tracer.span("step", step=name):
+                    result = self.funcs[name]()
+        except Exception as e:
+            traceback.print_exc()
+            sys.stderr.flush()
+            with self._cond:
+                self.errors[name] = e
+        else:
+            with self._cond:
+                self.results[name] = result
+        finally:
+            with self._cond:
+                self.timings[name] = (start, time.time())
+                self._cond.notify_all()
+
+    def run(self):
+        # Returns the results of the steps by name, or raises the error of
+        # the step that failed first (the errors of any others have been
+        # printed as they happened).  Steps skipped because a step before
+        # them failed are in errors as StepFailed.
+        # steps' spans nest under the span run() is called in
+        parent = None if self.tracer is None else self.tracer.current()
+        pending = list(self.steps)
+        running = set()
+        with self._cond:
+            while pending or running:
+                running.difference_update(self.timings)
+
+                for name in list(pending):
+                    after = self.after[name]
+                    if any(dependency in self.errors for dependency in after):
+                        pending.remove(name)
+                        self.errors[name] = StepFailed(
+                            "step {} skipped: {} failed".format(
+                                name, ", ".join(
+                                    dependency for dependency in after
+                                    if dependency in self.errors)))
+                        continue
+
+                    if all(dependency in self.results
+                           for dependency in after):
+                        pending.remove(name)
+                        running.add(name)
+                        thread = threading.Thread(
+                            target=self._run_step, args=(name, parent))
+                        thread.daemon = True
+                        thread.start()
+
+                if running:
+                    self._cond.wait()
+
+        failed = [name for name in self.errors if name in self.timings]
+        if failed:
+            raise self.errors[
+                min(failed, key=lambda name: self.timings[name][1])]
+
+        return self.results
+
+    def critical_path(self):
+        # The chain of steps that determined the run's duration: starting
+        # from the step that finished last, each step's latest-finishing
+        # predecessor.  Returns [(name, duration)].
+        if not self.timings:
+            return []
+
+        path = []
+        name = max(self.timings, key=lambda step: self.timings[step][1])
+        while name is not None:
+            start, end = self.timings[name]
+            path.append((name, end - start))
+
+            finished = [dependency for dependency in self.after[name]
+                        if dependency in self.timings]
+            name = (max(finished, key=lambda step: self.timings[step][1])
+                    if finished else None)
+
+        path.reverse()
+        return path
+
+    def report(self, notify):
+        # Describe the critical path, and how long the run took overall,
+        # through notify().
+        path = self.critical_path()
+        if not path:
+            return
+
+        start = min(start for start, _ in self.timings.values())
+        end = max(end for _, end in self.timings.values())
+        notify("critical path ({:.1f}s of {:.1f}s): {}".format(
+            sum(duration for _, duration in path),
+            end - start,
+            " -> ".join(
+                "{} {:.1f}s".format(name, duration)
+                for name, duration in path)))
@@ -8,6 +8,8 @@
  * Commands:
  *   hubot stage [revision] - stages the specified revision
  *   hubot deploy - deploys the staged revision
+ *   hubot status - reports instances, revisions, elastic IPs and open ports
+ *   hubot queue - reports queued and running deployment jobs
  *
  * Author:
  *   opadron
@@ -16,142 +18,217 @@
 "use strict";
 
 let child_process = require("child_process");
+let net = require("net");
+
+// socket of the deployment daemon (python main.py daemon); without one, every
+// command runs a fresh python main.py
+const SOCKET_PATH = "scratch/sumobot.sock";
+
+// Send a request to the daemon and call onEvent for each event it streams
+// back.  If no daemon is listening, call fallback instead.
+const daemonRequest = (request, onEvent, fallback) => {
+  let conn = net.createConnection(SOCKET_PATH);
+  let connected = false;
+  let buffer = "";
+
+  conn.on("connect", () => {
+    connected = true;
+    conn.write(JSON.stringify(request) + "\n");
+  });
+
+  conn.on("data", (data) => {
+    buffer += data.toString();
+    let lines = buffer.split("\n");
+    buffer = lines.pop();
+    lines.forEach((line) => {
+      if(line !== "") {
+        onEvent(JSON.parse(line));
+      }
+    });
+  });
 
-const clearDevopsLock = (robot, res) => {
-  robot.brain.set("devopsInProgress", "none");
-  res.reply("devops lock cleared");
+  conn.on("error", (e) => {
+    if(connected) {
+      onEvent({event: "error", message: e.toString()});
+    } else {
+      fallback();
+    }
+  });
 };
 
-const checkDevOps = (robot, res, op) => {
-  let devopsInProgress = robot.brain.get("devopsInProgress");
-  let result = (devopsInProgress === "staging" ||
-                devopsInProgress === "deployment");
+const relayLines = (res, data, prefix) => {
+  data.toString().split("\n").forEach((line) => {
+    if(line === "") {
+      return;
+    }
 
-  if(result) {
-    res.reply(
-      `cannot ${op}: ${devopsInProgress} operation currently in progress`);
-  }
+    if(prefix) {
+      res.reply(`${prefix}${line}`);
+    } else {
+      let match = line.match(/^BOT: (.*)/);
+      if(match) {
+        res.reply(match[1]);
+      }
+    }
+    console.log(line);
+  });
+};
 
-  return result;
+// stage and deploy are queued by main.py; the request completes once the
+// queued job has finished, relaying the job's bot messages as it goes and
+// the tail of its output (as ERR: lines) if it fails
+const runQueued = (res, request, commandArgs) => {
+  daemonRequest(request, (event) => {
+    if(event.event === "bot") {
+      res.reply(event.message);
+    } else if(event.event === "log") {
+      console.log(event.line);
+    } else if(event.event === "err") {
+      res.reply(`ERR: ${event.line}`);
+      console.log(event.line);
+    } else if(event.event === "error") {
+      res.reply(`ERR: ${event.message}`);
+    } else if(event.event === "done" && event.code !== 0) {
+      res.reply(`job exited with code: ${event.code}`);
+    }
+  }, () => spawnQueued(res, commandArgs));
 };
 
-module.exports = (robot) => {
-  robot.respond(/clear devops lock(.*)/i, (res) => {
-    clearDevopsLock(robot, res);
+const spawnQueued = (res, commandArgs) => {
+  let proc = child_process.spawn("python", commandArgs);
+
+  proc.stdout.on("data", (data) => relayLines(res, data));
+  proc.stderr.on("data", (data) => relayLines(res, data, "ERR: "));
+
+  proc.on("close", (code) => {
+    if(code !== 0) {
+      let msg = `process exited with code: ${code}`;
+      console.log(msg);
+      res.reply(msg);
+    }
   });
+};
 
-  robot.respond(/stage(.*)/i, (res) => {
-    if(!checkDevOps(robot, res, "stage")) {
-      robot.brain.set("devopsInProgress", "staging");
-      let commandArgs = ["main.py", "stage"];
-      let revision = res.match[1].trim();
-      if(revision) {
-        commandArgs.push("--revision");
-        commandArgs.push(revision);
-      }
+const renderQueue = (report) => {
+  let pending = report.jobs.filter(
+    (job) => job.state === "queued" || job.state === "running");
 
-      let proc = child_process.spawn("python", commandArgs);
-
-      proc.stdout.on("data", (data) => {
-        data = data.toString().split("\n");
-        let i;
-        let match;
-        for(i=0; i<data.length - 1; ++i) {
-          match = data[i].match(/^BOT: (.*)/);
-          if(match) {
-            res.reply(match[1]);
-          }
-          console.log(data[i]);
-        }
-
-        let last = data[data.length - 1];
-        if(last !== "") {
-          match = last.match(/^BOT: (.*)/);
-          if(match) {
-            res.reply(match[1]);
-          }
-          console.log(last);
-        }
-      });
+  if(pending.length === 0) {
+    return "queue is empty";
+  }
 
-      proc.stderr.on("data", (data) => {
-        data = data.toString().split("\n");
-        let i;
-        for(i=0; i<data.length - 1; ++i) {
-          res.reply(`ERR: ${data[i]}`);
-          console.log(data[i]);
-        }
-
-        let last = data[data.length - 1];
-        if(last !== "") {
-          res.reply(`ERR: ${last}`);
-          console.log(last);
-        }
-      });
+  let lines = pending.map((job) => {
+    let revision = job.revision ? ` ${job.revision}` : "";
+    let where = (job.state === "running" ?
+      `running for ${Math.round(Date.now()/1000 - job.started)}s` :
+      `queued at position ${job.position}`);
+    let requests = job.requests > 1 ? ` (${job.requests} requests)` : "";
+    return `job ${job.id} ${job.operation}${revision}: ${where}${requests}`;
+  });
 
-      proc.on("close", (code) => {
-        if(code !== 0) {
-          let msg = `process exited with code: ${code}`;
-          console.log(msg);
-          res.reply(msg);
-        }
-        clearDevopsLock(robot, res);
-      });
+  if(!report.runner) {
+    lines.push("warning: no queue runner is active");
+  }
+
+  return lines.join("\n");
+};
+
+const report = (res, request, commandArgs, render) => {
+  daemonRequest(request, (event) => {
+    if(event.event === "result") {
+      res.reply(render(event.data));
+    } else if(event.event === "error") {
+      res.reply(`${request.operation} failed: ${event.message}`);
     }
+  }, () => spawnReport(res, commandArgs, render));
+};
+
+const spawnReport = (res, commandArgs, render) => {
+  let proc = child_process.spawn("python", commandArgs);
+  let output = "";
+
+  proc.stdout.on("data", (data) => {
+    output += data.toString();
   });
 
-  robot.respond(/deploy/i, (res) => {
-    if(!checkDevOps(robot, res, "deploy")) {
-      robot.brain.set("devopsInProgress", "deployment");
-      let commandArgs = ["main.py", "deploy"];
-      let proc = child_process.spawn("python", commandArgs);
-
-      proc.stdout.on("data", (data) => {
-        data = data.toString().split("\n");
-        let i;
-        let match;
-        for(i=0; i<data.length - 1; ++i) {
-          match = data[i].match(/^BOT: (.*)/);
-          if(match) {
-            res.reply(match[1]);
-          }
-          console.log(data[i]);
-        }
-
-        let last = data[data.length - 1];
-        if(last !== "") {
-          match = last.match(/^BOT: (.*)/);
-          if(match) {
-            res.reply(match[1]);
-          }
-          console.log(last);
-        }
-      });
+  proc.stderr.on("data", (data) => {
+    console.log(data.toString());
+  });
 
-      proc.stderr.on("data", (data) => {
-        data = data.toString().split("\n");
-        let i;
-        for(i=0; i<data.length - 1; ++i) {
-          res.reply(`ERR: ${data[i]}`);
-          console.log(data[i]);
-        }
-
-        let last = data[data.length - 1];
-        if(last !== "") {
-          res.reply(`ERR: ${last}`);
-          console.log(last);
-        }
-      });
+  proc.on("close", (code) => {
+    if(code !== 0) {
+      res.reply(`${commandArgs[1]} failed with code: ${code}`);
+      return;
+    }
+
+    try {
+      res.reply(render(JSON.parse(output)));
+    } catch(e) {
+      res.reply(`could not parse ${commandArgs[1]}: ${e}`);
+    }
+  });
+};
+
+const renderStatus = (report) => {
+  let lines = [];
+
+  Object.keys(report.addresses).sort().forEach((name) => {
+    let address = report.addresses[name];
+    lines.push(
+      `${name}: ${address.ip} -> ${address.instance_id || "unassociated"}`);
+  });
+
+  Object.keys(report.roles).sort().forEach((role) => {
+    let states = report.roles[role];
+    let stateNames = Object.keys(states).sort();
+    if(stateNames.length === 0) {
+      lines.push(`${role}: no instances`);
+    }
 
-      proc.on("close", (code) => {
-        if(code !== 0) {
-          let msg = `process exited with code: ${code}`;
-          console.log(msg);
-          res.reply(msg);
-        }
-        clearDevopsLock(robot, res);
+    stateNames.forEach((state) => {
+      states[state].forEach((instance) => {
+        let ports = Object.keys(instance.ports)
+          .sort((a, b) => a - b)
+          .map((port) => `${port}${instance.ports[port] ? "+" : "-"}`)
+          .join(" ");
+        let revision = (instance.revision || "-").substr(0, 10);
+        let eips = instance.elastic_ip.map((name) => ` [${name}]`).join("");
+
+        lines.push(
+          `${role} (${state}): ${instance.id} ${instance.public_ip || "-"} ` +
+          `rev=${revision} ports=[${ports}]${eips}`);
       });
+    });
+  });
+
+  return lines.join("\n");
+};
+
+module.exports = (robot) => {
+  robot.respond(/status$/i, (res) => {
+    report(res, {operation: "status"}, ["main.py", "status", "--json"],
+           renderStatus);
+  });
+
+  robot.respond(/queue$/i, (res) => {
+    report(res, {operation: "queue"}, ["main.py", "queue", "--json"],
+           renderQueue);
+  });
+
+  robot.respond(/stage(.*)/i, (res) => {
+    let commandArgs = ["main.py", "stage"];
+    let request = {operation: "stage"};
+    let revision = res.match[1].trim();
+    if(revision) {
+      commandArgs.push("--revision");
+      commandArgs.push(revision);
+      request.revision = revision;
     }
+
+    runQueued(res, request, commandArgs);
   });
-}
 
+  robot.respond(/deploy$/i, (res) => {
+    runQueued(res, {operation: "deploy"}, ["main.py", "deploy"]);
+  });
+}
@@ -0,0 +1,211 @@
+
+import functools
+import json
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+
+_THROTTLE_CODES = frozenset((
+    "Throttling",
+    "ThrottlingException",
+    "RequestLimitExceeded",
+    "RequestThrottled",
+    "TooManyRequestsException",
+))
+
+def traced(func):
+    # Wrap a Deployment method in a span named after it.
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwds):
+        with self.tracer.span(func.__name__):
+            return func(self, *args, **kwds)
+
+    return wrapper
+
+class Tracer(object):
+    # Collects nested wall-clock spans and per-operation AWS API counters.
+    #
+    # Spans nest per thread; worker threads pick up the span that started
+    # them through wrap() or under().  API calls are counted by operation
+    # name, along with the retries botocore made for them and the throttling
+    # errors it saw, and are also attributed to the innermost span of the
+    # calling thread.
+
+    def __init__(self):
+        self.spans = []
+        self.api_calls = {}
+        self.api_retries = {}
+        self.api_throttles = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def current(self):
+        # innermost open span of the calling thread, or None
+        stack = self._stack()
+        return stack[-1] if stack else None
+
+    @contextmanager
+    def under(self, parent):
+        # Nest the spans the calling thread opens in the block under parent,
+        # a span another thread has open (see current()).
+        stack = self._stack()
+        if parent is not None:
+            stack.append(parent)
+        try:
+            yield
+        finally:
+            if parent is not None:
+                stack.pop()
+
+    def wrap(self, func):
+        # func, made to nest its spans under the caller's current span
+        # wherever it runs
+        parent = self.current()
+
+        def wrapper(*args, **kwds):
+            with self.under(parent):
+                return func(*args, **kwds)
+
+        return wrapper
+
+    def reset(self):
+        # Forget everything recorded so far, e.g.: between the requests a
+        # long-lived process serves.
+        with self._lock:
+            self.spans = []
+            self.api_calls = {}
+            self.api_retries = {}
+            self.api_throttles = {}
+
+    @contextmanager
+    def span(self, name, **attrs):
+        stack = self._stack()
+        span = {
+            "name": name,
+            "start": time.time(),
+            "api_calls": 0,
+            "children": [],
+        }
+        if attrs:
+            span["attrs"] = attrs
+
+        with self._lock:
+            (stack[-1]["children"] if stack else self.spans).append(span)
+
+        stack.append(span)
+        try:
+            yield span
+        except Exception as e:
+            span["error"] = "{}: {}".format(type(e).__name__, e)
+            raise
+        finally:
+            stack.pop()
+            span["end"] = time.time()
+            span["duration"] = span["end"] - span["start"]
+
+    def _count(self, counter, operation, amount=1):
+        with self._lock:
+            counter[operation] = counter.get(operation, 0) + amount
+
+    def instrument(self, target):
+        # target is anything with an event emitter: a session, or a
+        # client's meta
+        target.events.register("before-call", self._before_call)
+        target.events.register("after-call", self._after_call)
+        target.events.register("needs-retry", self._needs_retry)
+
+    def _before_call(self, model, **kwds):
+        self._count(self.api_calls, model.name)
+        stack = self._stack()
+        if stack:
+            with self._lock:
+                stack[-1]["api_calls"] += 1
+
+    def _after_call(self, model, parsed=None, **kwds):
+        attempts = (parsed or {}).get(
+            "ResponseMetadata", {}).get("RetryAttempts", 0)
+        if attempts:
+            self._count(self.api_retries, model.name, attempts)
+
+    def _needs_retry(self, response=None, operation=None, **kwds):
+        if response is None or operation is None:
+            return
+
+        code = response[1].get("Error", {}).get("Code")
+        if code in _THROTTLE_CODES:
+            self._count(self.api_throttles, operation.name)
+
+    def iter_spans(self, spans=None, depth=0):
+        for span in (self.spans if spans is None else spans):
+            yield depth, span
+            for entry in self.iter_spans(span["children"], depth + 1):
+                yield entry
+
+    def to_json(self):
+        with self._lock:
+            return {
+                "spans": self.spans,
+                "api": {
+                    "calls": dict(self.api_calls),
+                    "retries": dict(self.api_retries),
+                    "throttles": dict(self.api_throttles),
+                },
+            }
+
+    def to_prometheus(self, prefix="sumobot"):
+        durations = {}
+        counts = {}
+        for _, span in self.iter_spans():
+            if "duration" not in span: continue
+            durations[span["name"]] = (
+                durations.get(span["name"], 0.0) + span["duration"])
+            counts[span["name"]] = counts.get(span["name"], 0) + 1
+
+        lines = []
+
+        def metric(name, kind, doc, label, values):
+            lines.append("# HELP {}_{} {}".format(prefix, name, doc))
+            lines.append("# TYPE {}_{} {}".format(prefix, name, kind))
+            for key, value in sorted(values.items()):
+                lines.append('{}_{}{{{}="{}"}} {}'.format(
+                    prefix, name, label, key, value))
+
+        metric("phase_duration_seconds", "gauge",
+               "Wall-clock time spent in each deployment phase.",
+               "phase", durations)
+        metric("phase_runs", "gauge",
+               "Number of times each deployment phase ran.",
+               "phase", counts)
+
+        with self._lock:
+            metric("aws_api_calls_total", "counter",
+                   "AWS API calls made, by operation.",
+                   "operation", self.api_calls)
+            metric("aws_api_retries_total", "counter",
+                   "AWS API call retries, by operation.",
+                   "operation", self.api_retries)
+            metric("aws_api_throttles_total", "counter",
+                   "AWS API throttling errors, by operation.",
+                   "operation", self.api_throttles)
+
+        lines.append("")
+        return "\n".join(lines)
+
+    def write(self, json_path, prometheus_path):
+        for path, content in (
+                (json_path, json.dumps(self.to_json(), indent=2)),
+                (prometheus_path, self.to_prometheus())):
+            # write-then-rename, so that readers (e.g.: the node exporter's
+            # textfile collector) never see a partial file
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "w") as f:
+                f.write(content)
+            os.rename(tmp_path, path)
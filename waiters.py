@@ -0,0 +1,30 @@
+
+import time
+
+class WaitTimeout(Exception):
+    pass
+
+def backoff_delays(initial=1.0, factor=2.0, maximum=15.0):
+    delay = initial
+    while True:
+        yield delay
+        delay = min(delay*factor, maximum)
+
+def wait_for(condition, timeout=300.0, initial=1.0, factor=2.0, maximum=15.0,
+             description="condition"):
+    # Poll condition() until it returns a true value, sleeping with bounded
+    # exponential backoff in between.  Returns (value, seconds waited), or
+    # raises WaitTimeout once timeout seconds have passed.
+    start = time.time()
+    delays = backoff_delays(initial, factor, maximum)
+    while True:
+        result = condition()
+        elapsed = time.time() - start
+        if result:
+            return result, elapsed
+
+        if elapsed >= timeout:
+            raise WaitTimeout("timed out after {:.1f}s waiting for {}".format(
+                elapsed, description))
+
+        time.sleep(min(next(delays), timeout - elapsed))